@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+
+import argparse
+import asyncio
+import base64
+import multiprocessing
+import os
+import pathlib
+import plistlib
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+from utils.archive import ArchiveCache, BlobArchiver
+
+
+def create_blobs(root: pathlib.Path, devices: int, firmwares: int) -> list[str]:
+    ecids = list()
+    for d in range(devices):
+        ecid = f'{0x1000000000 + d:x}'
+        ecids.append(ecid)
+
+        for f in range(firmwares):
+            save_path = root / ecid / f'15.{f}' / f'19A{f:03}' / 'no-apnonce'
+            save_path.mkdir(parents=True)
+
+            for gen in ('0x1111111111111111', '0xbd34a880be0b53f3'):
+                blob = {
+                    'ApImg4Ticket': os.urandom(2048),
+                    'generator': gen,
+                    'BBTicket': base64.b64encode(os.urandom(4096)).decode(),
+                }
+                (save_path / f'{ecid}_{gen}_15.{f}-19A{f:03}.shsh2').write_bytes(
+                    plistlib.dumps(blob)
+                )
+
+    return ecids
+
+
+def create_tar(root: pathlib.Path, tmpdir: pathlib.Path, ecids: list[str]) -> None:
+    # The original export: copy every device's blobs, then compress them in one go
+    copy_path = tmpdir / 'SHSH Blobs'
+    copy_path.mkdir()
+    for ecid in ecids:
+        shutil.copytree(root / ecid, copy_path / ecid)
+
+    with tarfile.open(tmpdir / 'Blobs.tar.xz', 'w:xz') as tar:
+        tar.add(copy_path, arcname=copy_path.name)
+
+
+async def parallel_archive(
+    cache: ArchiveCache, path: pathlib.Path, ecids: list[str], fmt: str, level: int
+) -> None:
+    fragments = await asyncio.gather(
+        *[cache.get(ecid, 'multi', fmt, level) for ecid in ecids]
+    )
+    await asyncio.to_thread(
+        cache.archiver.concat,
+        path,
+        [f for f in fragments if f is not None],
+        fmt,
+        level,
+    )
+
+
+def timed(name: str, func, *args) -> float:
+    start_time = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start_time
+
+    print(f'{name:<32} {elapsed:>8.2f}s')
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Compare blob export archivers on a synthetic blob store.'
+    )
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--firmwares', type=int, default=20)
+    parser.add_argument(
+        '--format', default='tar.xz', choices=('tar.xz', 'tar.gz', 'tar.bz2')
+    )
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = pathlib.Path(tmpdir)
+        root = tmpdir / 'Blobs'
+        ecids = create_blobs(root, args.devices, args.firmwares)
+        print(
+            f'{args.devices} devices, {args.devices * args.firmwares * 2} blobs, {args.format} level {args.level}, {args.workers} workers, {os.cpu_count()} CPUs\n'
+        )
+
+        (legacy_path := tmpdir / 'legacy').mkdir()
+        timed('_create_tar (copy + xz)', create_tar, root, legacy_path, ecids)
+
+        archiver = BlobArchiver(root)
+        timed(
+            'BlobArchiver.write (1 thread)',
+            archiver.write,
+            tmpdir / f'stream.{args.format}',
+            ecids,
+            args.format,
+            args.level,
+        )
+
+        # Without an executor, fragments are compressed in threads like bot.py does
+        # when AUTOTSS_ARCHIVE_PROCESSES is 1
+        cache = ArchiveCache(archiver, tmpdir / 'Cache')
+        for run in ('cold', 'cached'):
+            timed(
+                f'ArchiveCache in-process ({run})',
+                asyncio.run,
+                parallel_archive(
+                    cache,
+                    tmpdir / f'inprocess-{run}.{args.format}',
+                    ecids,
+                    args.format,
+                    args.level,
+                ),
+            )
+
+        pool = ProcessPoolExecutor(
+            max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')
+        )
+        with pool:
+            timed('Pool startup', lambda: pool.submit(int).result())
+
+            cache = ArchiveCache(archiver, tmpdir / 'PoolCache', executor=pool)
+            for run in ('cold', 'cached'):
+                timed(
+                    f'ArchiveCache + pool ({run})',
+                    asyncio.run,
+                    parallel_archive(
+                        cache,
+                        tmpdir / f'parallel-{run}.{args.format}',
+                        ecids,
+                        args.format,
+                        args.level,
+                    ),
+                )
+
+        for name in (
+            'legacy/Blobs.tar.xz',
+            f'stream.{args.format}',
+            f'inprocess-cold.{args.format}',
+            f'parallel-cold.{args.format}',
+        ):
+            print(
+                f'{name:<32} {(tmpdir / name).stat().st_size / 1024 / 1024:>8.2f} MiB'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
+from cogs.botutils import API_CONCURRENCY, API_TIMEOUT
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from dotenv.main import load_dotenv
+from utils.asynczip import AsyncRemoteZip
+from utils.database import Database
 from utils.logger import Logger
+from utils.manifestcache import ManifestCache
+from utils.scheduler import ProcessScheduler
 
 import aiohttp
 import aiopath
 import aiosqlite
 import asyncio
 import discord
+import multiprocessing
 import ujson
 import os
 import shutil
@@ -16,6 +23,70 @@ import sys
 import time
 
 
+async def migrate_db(db: aiosqlite.Connection) -> None:
+    async with db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'autotss'"
+    ) as cursor:
+        if await cursor.fetchone() is None:  # Nothing to migrate
+            return
+
+    print('[INFO] Migrating devices to the new database schema...')
+    async with db.execute('SELECT user, devices, enabled FROM autotss') as cursor:
+        data = await cursor.fetchall()
+
+    for user, devices, enabled in data:
+        devices = ujson.loads(devices)
+        if len(devices) == 0:
+            continue
+
+        user_added = False
+        for device in devices:
+            ecid = device['ecid'].lower().removeprefix('0x')
+            async with db.execute(
+                'SELECT 1 FROM devices WHERE ecid = ?', (ecid,)
+            ) as cursor:
+                if (
+                    await cursor.fetchone() is not None
+                ):  # ECID was already added by another user
+                    print(
+                        f"[WARNING] Skipping duplicate ECID: {device['ecid']} for user: {user}."
+                    )
+                    continue
+
+            if not user_added:  # Users without any migrated devices aren't added
+                await db.execute(
+                    'INSERT OR IGNORE INTO users(user, enabled) VALUES(?,?)',
+                    (user, enabled),
+                )
+                user_added = True
+
+            cursor = await db.execute(
+                'INSERT INTO devices(user, name, identifier, ecid, boardconfig, generator, apnonce) VALUES(?,?,?,?,?,?,?)',
+                (
+                    user,
+                    device['name'],
+                    device['identifier'],
+                    ecid,
+                    device['boardconfig'],
+                    device['generator'],
+                    device['apnonce'],
+                ),
+            )
+
+            await db.executemany(
+                'INSERT OR IGNORE INTO saved_blobs(device, version, buildid) VALUES(?,?,?)',
+                [
+                    (cursor.lastrowid, firm['version'], firm['buildid'])
+                    for firm in device['saved_blobs']
+                ],
+            )
+
+    await db.execute(
+        'ALTER TABLE autotss RENAME TO autotss_legacy'
+    )  # Keep the old data around in case anything went wrong
+    await db.commit()
+
+
 async def startup():
     if sys.version_info[:2] < (3, 9):
         sys.exit('[ERROR] AutoTSS requires Python 3.9 or higher. Exiting.')
@@ -84,6 +155,28 @@ async def startup():
             "[ERROR] Invalid owner ID set in 'AUTOTSS_OWNER' environment variable. Exiting."
         )
 
+    limits = dict()
+    for env, default in (
+        ('AUTOTSS_API_CONCURRENCY', API_CONCURRENCY),
+        ('AUTOTSS_API_HOST_LIMIT', 8),
+        ('AUTOTSS_MAX_PROCESSES', min(32, (os.cpu_count() or 1) + 4)),
+        ('AUTOTSS_MANIFEST_CACHE_SIZE', 512),
+        ('AUTOTSS_ARCHIVE_PROCESSES', os.cpu_count() or 1),
+        ('AUTOTSS_ARCHIVE_CACHE_SIZE', 256),
+        ('AUTOTSS_DB_READERS', 4),
+    ):
+        try:
+            limits[env] = int(os.environ.get(env, default))
+        except ValueError:
+            sys.exit(
+                f"[ERROR] Invalid value set in '{env}' environment variable. Exiting."
+            )
+
+        if limits[env] <= 0:
+            sys.exit(
+                f"[ERROR] Invalid value set in '{env}' environment variable. Exiting."
+            )
+
     mentions = discord.AllowedMentions(everyone=False, roles=False)
     (intents := discord.Intents.default()).members = True
 
@@ -107,16 +200,114 @@ async def startup():
 
     db_path = aiopath.AsyncPath('Data/autotss.db')
     await db_path.parent.mkdir(exist_ok=True)
-    async with aiosqlite.connect(db_path) as db, aiohttp.ClientSession() as session:
+    bot.get_cog('Utilities').api_sem = asyncio.Semaphore(
+        limits['AUTOTSS_API_CONCURRENCY']
+    )
+    bot.get_cog('Utilities').scheduler = ProcessScheduler(
+        limits['AUTOTSS_MAX_PROCESSES']
+    )
+    bot.get_cog('Utilities').manifest_cache = ManifestCache(
+        max_size=limits['AUTOTSS_MANIFEST_CACHE_SIZE']
+    )
+
+    # Spawn archive workers instead of forking the event loop and database threads. A
+    # single spawned worker is slower than compressing in a thread, so it's skipped
+    archive_pool = None
+    if limits['AUTOTSS_ARCHIVE_PROCESSES'] > 1:
+        archive_pool = ProcessPoolExecutor(
+            max_workers=limits['AUTOTSS_ARCHIVE_PROCESSES'],
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        bot.get_cog('Utilities').archive_cache.executor = archive_pool
+
+    bot.get_cog('Utilities').archive_cache.max_size = (
+        limits['AUTOTSS_ARCHIVE_CACHE_SIZE'] * 1024 * 1024
+    )  # MiB -> bytes
+
+    connector = aiohttp.TCPConnector(
+        limit_per_host=limits['AUTOTSS_API_HOST_LIMIT']
+    )  # Limit concurrent connections to a single API host
+    async with aiosqlite.connect(db_path) as db, aiohttp.ClientSession(
+        connector=connector
+    ) as session:
+        await db.execute('PRAGMA foreign_keys = ON')
+        # WAL lets reads run alongside the blob saver's writes, and makes it safe to
+        # skip an fsync on every commit
+        await db.execute('PRAGMA journal_mode = WAL')
+        await db.execute('PRAGMA synchronous = NORMAL')
+        await db.execute('PRAGMA cache_size = -16384')  # 16 MiB
+        await db.execute('PRAGMA temp_store = MEMORY')
+
         await db.execute(
             '''
-            CREATE TABLE IF NOT EXISTS autotss(
-            user INTEGER,
-            devices JSON,
+            CREATE TABLE IF NOT EXISTS users(
+            user INTEGER PRIMARY KEY,
             enabled BOOLEAN
             )
             '''
         )
+        await db.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS devices(
+            id INTEGER PRIMARY KEY,
+            user INTEGER REFERENCES users(user) ON UPDATE CASCADE ON DELETE CASCADE,
+            name TEXT,
+            identifier TEXT,
+            ecid TEXT,
+            boardconfig TEXT,
+            generator TEXT,
+            apnonce TEXT
+            )
+            '''
+        )
+        await db.execute('CREATE INDEX IF NOT EXISTS devices_user ON devices(user)')
+        await db.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS devices_ecid ON devices(ecid)'
+        )
+        await db.execute(
+            'CREATE INDEX IF NOT EXISTS devices_identifier ON devices(identifier)'
+        )
+        await db.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS saved_blobs(
+            device INTEGER REFERENCES devices(id) ON DELETE CASCADE,
+            version TEXT,
+            buildid TEXT,
+            PRIMARY KEY(device, buildid)
+            )
+            '''
+        )
+        await db.commit()
+
+        await db.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS blobs(
+            ecid TEXT,
+            path TEXT,
+            name TEXT,
+            generator TEXT,
+            PRIMARY KEY(ecid, path, name)
+            )
+            '''
+        )
+        await db.commit()
+
+        await migrate_db(db)
+
+        await db.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS firmwares(
+            identifier TEXT,
+            version TEXT,
+            buildid TEXT,
+            url TEXT,
+            signed BOOLEAN
+            )
+            '''
+        )
+        await db.execute(
+            'CREATE INDEX IF NOT EXISTS firmwares_identifier ON firmwares(identifier)'
+        )
         await db.commit()
 
         await db.execute(
@@ -131,11 +322,10 @@ async def startup():
         await db.commit()
 
         async with db.execute(
-            'SELECT devices from autotss WHERE enabled = ?', (True,)
+            'SELECT COUNT(*) FROM devices INNER JOIN users ON devices.user = users.user WHERE users.enabled = ?',
+            (True,),
         ) as cursor:
-            num_devices = sum(
-                len(ujson.loads(devices[0])) for devices in await cursor.fetchall()
-            )
+            num_devices = (await cursor.fetchone())[0]
 
         bot.activity = discord.Game(
             name=f"Saving SHSH blobs for {num_devices} device{'s' if num_devices != 1 else ''}."
@@ -145,9 +335,16 @@ async def startup():
         bot.get_cog('Utilities').sem = asyncio.Semaphore(cpu_count)
 
         # Setup bot attributes
-        bot.db = db
+        bot.db = Database(db)
+        bot.get_cog('Utilities').device_count = num_devices
+        await bot.get_cog('Utilities').load_registered_users()
+        await bot.db.open_readers(db_path, limits['AUTOTSS_DB_READERS'])
+        await bot.get_cog('Utilities').load_blob_index()
         bot.max_devices = max_devices
         bot.session = session
+        bot.get_cog('Utilities').remote_zip = AsyncRemoteZip(
+            session, timeout=API_TIMEOUT
+        )
         bot.start_time = await asyncio.to_thread(datetime.now)
 
         if 'AUTOTSS_WEBHOOK' in os.environ.keys():
@@ -165,6 +362,11 @@ async def startup():
             sys.exit(
                 "[ERROR] Server Members Intent not enabled, go to 'https://discord.com/developers/applications' and enable the Server Members Intent. Exiting."
             )
+        finally:
+            if archive_pool is not None:
+                archive_pool.shutdown(cancel_futures=True)
+
+            await bot.db.close_readers()
 
 
 if __name__ == '__main__':
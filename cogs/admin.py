@@ -2,13 +2,13 @@ from .botutils import UtilsCog
 from discord.errors import ExtensionAlreadyLoaded, ExtensionFailed, ExtensionNotLoaded
 from discord.ext import commands
 from discord.commands import permissions, Option
+from utils.archive import ARCHIVE_FORMATS
 from views.buttons import PaginatorView, SelectView
 
 import aiofiles
 import aiopath
 import asyncio
 import discord
-import ujson
 import time
 
 
@@ -225,16 +225,30 @@ class AdminCog(commands.Cog, name='Administrator'):
         name='downloadall',
         description='Download SHSH blobs for all devices in AutoTSS.',
     )
-    async def download_all_blobs(self, ctx: discord.ApplicationContext) -> None:
+    async def download_all_blobs(
+        self,
+        ctx: discord.ApplicationContext,
+        fmt: Option(
+            str,
+            name='format',
+            description='Archive format',
+            choices=ARCHIVE_FORMATS,
+            default='tar.gz',  # Much faster than xz over the whole blob store
+        ),
+        level: Option(
+            int,
+            description='Compression level (0-9)',
+            min_value=0,
+            max_value=9,
+            required=False,
+        ),
+    ) -> None:
         await ctx.defer(ephemeral=True)
 
         if await self.bot.is_owner(ctx.author) == False:
             raise commands.NotOwner()
 
-        async with self.bot.db.execute('SELECT devices from autotss') as cursor:
-            num_devices = sum(
-                len(ujson.loads(devices[0])) for devices in await cursor.fetchall()
-            )
+        num_devices = await self.utils.count_devices()
 
         if num_devices == 0:
             embed = discord.Embed(
@@ -249,21 +263,22 @@ class AdminCog(commands.Cog, name='Administrator'):
             if ecid.is_dir()
         ]
         async with aiofiles.tempfile.TemporaryDirectory() as tmpdir:
-            tar = await self.utils.backup_blobs(aiopath.AsyncPath(tmpdir), *ecids)
-
-        if tar is None:
-            embed = discord.Embed(
-                title='Error', description='There are no SHSH blobs saved in AutoTSS.'
+            tar = await self.utils.backup_blobs(
+                aiopath.AsyncPath(tmpdir), *ecids, fmt=fmt, level=level
             )
-            await ctx.respond(embed=embed)
 
-        else:
-            embed = discord.Embed(
-                title='Download Blobs', description='Download all SHSH Blobs:'
-            )
-            await ctx.respond(
-                embed=embed, file=discord.File(fp=tar, filename='SHSH Blobs.tar.xz')
-            )
+            if tar is None:
+                embed = discord.Embed(
+                    title='Error',
+                    description='There are no SHSH blobs saved in AutoTSS.',
+                )
+                await ctx.respond(embed=embed)
+
+            else:
+                embed = discord.Embed(
+                    title='Download Blobs', description='Download all SHSH Blobs:'
+                )
+                await self.utils.send_archive(ctx, embed, tar, f'SHSH Blobs.{fmt}')
 
         self.bot.logger.info(f'Owner: `@{ctx.author}` has downloaded all SHSH blobs.')
 
@@ -277,12 +292,9 @@ class AdminCog(commands.Cog, name='Administrator'):
         if await self.bot.is_owner(ctx.author) == False:
             raise commands.NotOwner()
 
-        async with self.bot.db.execute(
-            'SELECT * from autotss WHERE enabled = ?', (True,)
-        ) as cursor:
-            data = await cursor.fetchall()
+        data = await self.utils.get_enabled_devices()
 
-        num_devices = sum(len(ujson.loads(devices[1])) for devices in data)
+        num_devices = sum(len(devices) for devices in data.values())
         if num_devices == 0:
             embed = discord.Embed(
                 title='Error', description='There are no devices added to AutoTSS.'
@@ -316,10 +328,8 @@ class AdminCog(commands.Cog, name='Administrator'):
         start_time = await asyncio.to_thread(time.time)
         data = await asyncio.gather(
             *[
-                self.utils.sem_call(
-                    self.utils.save_user_blobs, user_data[0], ujson.loads(user_data[1])
-                )
-                for user_data in data
+                self.utils.sem_call(self.utils.save_user_blobs, user, devices)
+                for user, devices in data.items()
             ]
         )
         finish_time = round(await asyncio.to_thread(time.time) - start_time)
@@ -347,6 +357,44 @@ class AdminCog(commands.Cog, name='Administrator'):
         await self.utils.update_device_count()
         await ctx.edit(embed=embed)
 
+    @admin.command(
+        name='reindex',
+        description='Rebuild the SHSH blob index from the blobs saved on disk.',
+    )
+    async def reindex_blobs(self, ctx: discord.ApplicationContext) -> None:
+        await ctx.defer(ephemeral=True)
+
+        if await self.bot.is_owner(ctx.author) == False:
+            raise commands.NotOwner()
+
+        if self.utils.saving_blobs:
+            embed = discord.Embed(
+                title='Hey!',
+                description="I'm saving SHSH blobs right now, please wait until I'm finished to rebuild the SHSH blob index.",
+            )
+            await ctx.respond(embed=embed)
+            return
+
+        self.utils.saving_blobs = True  # Don't let blobs be saved while reindexing
+        start_time = await asyncio.to_thread(time.time)
+        try:
+            num_blobs = await self.utils.rebuild_blob_index()
+        finally:
+            self.utils.saving_blobs = False
+        finish_time = round(await asyncio.to_thread(time.time) - start_time)
+
+        embed = discord.Embed(
+            title='Reindex Blobs',
+            description=f"Indexed **{num_blobs} SHSH blob{'s' if num_blobs != 1 else ''}** in **{finish_time} second{'s' if finish_time != 1 else ''}**.",
+        )
+        embed.set_footer(
+            text=ctx.author.display_name,
+            icon_url=ctx.author.display_avatar.with_static_format('png').url,
+        )
+        await ctx.respond(embed=embed)
+
+        self.bot.logger.info(f'Owner: `@{ctx.author}` has rebuilt the SHSH blob index.')
+
     @admin.command(
         name='dtransfer', description="Transfer a user's devices to another user."
     )
@@ -397,21 +445,8 @@ class AdminCog(commands.Cog, name='Administrator'):
             await ctx.respond(embed=invalid_embed)
             return
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (old.id,)
-        ) as cursor:
-            try:
-                old_devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                old_devices = list()
-
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (new.id,)
-        ) as cursor:
-            try:
-                new_devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                new_devices = list()
+        old_devices = await self.utils.get_devices(old.id)
+        new_devices = await self.utils.get_devices(new.id)
 
         if len(old_devices) == 0:
             invalid_embed.description = (
@@ -450,10 +485,27 @@ class AdminCog(commands.Cog, name='Administrator'):
             await ctx.edit(embed=cancelled_embed)
             return
 
+        if (
+            len(await self.utils.get_devices(new.id)) > 0
+        ):  # Devices may have been added while waiting for confirmation
+            invalid_embed.description = (
+                f'{new.mention} has devices added to AutoTSS already.'
+            )
+            await ctx.edit(embed=invalid_embed)
+            return
+
         await self.bot.db.execute(
-            'UPDATE autotss SET user = ? WHERE user = ?', (new.id, old.id)
+            'DELETE FROM users WHERE user = ? AND NOT EXISTS (SELECT 1 FROM devices WHERE devices.user = users.user)',
+            (new.id,),
         )
+        await self.bot.db.execute(
+            'UPDATE users SET user = ? WHERE user = ?', (new.id, old.id)
+        )  # Devices are transferred along with the user
         await self.bot.db.commit()
+        self.utils.registered_users.discard(old.id)
+        self.utils.registered_users.add(new.id)
+        await self.utils.load_device_count()
+        await self.utils.update_device_count()
 
         embed.description = f"Successfully transferred {old.mention}'s **{len(old_devices)} device{'s' if len(old_devices) != 1 else ''}** to {new.mention}."
         await ctx.edit(embed=embed)
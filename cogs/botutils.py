@@ -1,32 +1,100 @@
 from datetime import datetime
-from io import BytesIO
 from discord.enums import SlashCommandOptionType
-from discord.ext import commands
+from discord.ext import commands, tasks
 from hashlib import sha1, sha384
+from utils.archive import DEFAULT_LEVELS, ArchiveCache, BlobArchiver
+from utils.asynczip import AsyncRemoteZip, RemoteZipError
+from utils.blobindex import BlobIndex
+from utils.cache import AsyncTTLCache
 from utils.errors import *
-from typing import Optional, Union
+from utils.httpcache import HTTPCache
+from utils.manifestcache import ManifestCache
+from utils.scheduler import ProcessScheduler
+from typing import Iterable, Optional, Union
+from xml.parsers.expat import ExpatError
 
 import aiofiles
+import aiohttp
 import aiopath
 import asyncio
 import discord
-import glob
-import ujson
+import os
 import pathlib
-import remotezip
+import plistlib
 import shutil
 import sys
-import tarfile
+import time
 
 
 API_URL = 'https://api.ipsw.me/v4'
 BETA_API_URL = 'https://api.m1sta.xyz/betas'
 
+API_RETRIES = 3  # Number of times to retry a failed API request
+API_BACKOFF = 1  # Initial delay (in seconds) between retries, doubled on every retry
+API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+API_TIMEOUT = aiohttp.ClientTimeout(total=30)
+API_CONCURRENCY = 32  # Default number of firmware API requests to run at once
+FIRM_CACHE_TTL = 300  # Matches the auto blob saver's polling interval
+CATALOG_TTL = 3600  # Refreshed in the background well before this expires
+PRESENCE_DELAY = 5  # Seconds to wait for more device count changes
+MEMBER_BATCH_DELAY = 2  # Seconds to collect member events before writing them
+SQL_BATCH_SIZE = 500  # Stays under SQLite's limit on query parameters
+SAVED_BLOBS_BATCH_SIZE = 64  # Saved firmwares to write at once
+SAVED_BLOBS_BATCH_DELAY = 1  # Max seconds a saved firmware waits before it's written
+
+UPLOAD_LIMIT = (
+    8 * 1024 * 1024
+)  # Discord's attachment size limit outside of boosted guilds
+
+DEVICE_COLUMNS = (
+    'id',
+    'user',
+    'name',
+    'identifier',
+    'ecid',
+    'boardconfig',
+    'generator',
+    'apnonce',
+)
+
 
 class UtilsCog(commands.Cog, name='Utilities'):
     def __init__(self, bot: discord.Bot):
         self.bot = bot
         self.saving_blobs = False
+        self.api_sem = asyncio.Semaphore(API_CONCURRENCY)
+        self.http_cache = HTTPCache()
+        self.api_cache = AsyncTTLCache(FIRM_CACHE_TTL)
+        self.firm_cache = AsyncTTLCache(FIRM_CACHE_TTL)
+        self.catalog_cache = AsyncTTLCache(CATALOG_TTL)
+        self.tsschecker_stats = {'runs': 0, 'spawn_time': 0, 'run_time': 0}
+        self._tsschecker = None
+        self.scheduler = ProcessScheduler(min(32, (os.cpu_count() or 1) + 4))
+        self.manifest_cache = ManifestCache()
+        self.blob_index = BlobIndex()
+        self.archiver = BlobArchiver()
+        self.archive_cache = ArchiveCache(self.archiver)
+        self.remote_zip: Optional[AsyncRemoteZip] = None  # Set once the session exists
+        self._saved_blobs_queue: list[tuple[str, str, int]] = list()
+        self._saved_blobs_flush: Optional[asyncio.Task] = None
+        self.device_count = 0  # Devices with auto-saving enabled
+        self._presence_update: Optional[asyncio.Task] = None
+        self.registered_users: set[int] = set()  # Users with devices added
+        self._user_updates: dict[int, bool] = dict()
+        self._user_updates_flush: Optional[asyncio.Task] = None
+        self.catalog_refresher.start()
+
+    def cog_unload(self) -> None:
+        self.catalog_refresher.cancel()
+
+    @tasks.loop(minutes=30)
+    async def catalog_refresher(self) -> None:
+        await self.bot.wait_until_ready()
+
+        try:
+            await self.get_device_catalog(refresh=True)
+        except (APIError, aiohttp.ClientError, asyncio.TimeoutError):
+            self.bot.logger.warn('Failed to refresh device catalog from IPSW.me.')
 
     READABLE_INPUT_TYPES = {
         discord.TextChannel: 'channel',
@@ -56,9 +124,8 @@ class UtilsCog(commands.Cog, name='Utilities'):
         if boardconfig[-2:] != 'ap':
             return False
 
-        api = await self.fetch_ipswme_api(identifier)
-        if not any(
-            x['boardconfig'].lower() == boardconfig for x in api['boards']
+        if (
+            boardconfig not in (await self.get_boards(identifier)).keys()
         ):  # If no boardconfigs for the given device identifier match the boardconfig, then return False
             return False
         else:
@@ -78,17 +145,10 @@ class UtilsCog(commands.Cog, name='Utilities'):
         except (ValueError, TypeError):
             return -1
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss'
-        ) as cursor:  # Make sure the ECID the user provided isn't already a device added to AutoTSS.
-            try:
-                devices = [device[0] for device in (await cursor.fetchall())]
-            except TypeError:  # No devices in database
-                return 0
-
-        if any(
-            ecid in device_info for device_info in devices
-        ):  # There's no need to convert the json string to a dict here
+        if (
+            await self.bot.db.fetchone('SELECT 1 FROM devices WHERE ecid = ?', (ecid,))
+            is not None
+        ):  # Make sure the ECID the user provided isn't already a device added to AutoTSS.
             return -2
 
         return 0
@@ -110,10 +170,7 @@ class UtilsCog(commands.Cog, name='Utilities'):
         return True
 
     async def check_identifier(self, identifier: str) -> bool:
-        async with self.bot.session.get(f'{API_URL}/devices') as resp:
-            api = await resp.json()
-
-        if identifier not in [device['identifier'] for device in api]:
+        if identifier not in (await self.get_device_catalog()).keys():
             return False
 
         return True
@@ -122,15 +179,13 @@ class UtilsCog(commands.Cog, name='Utilities'):
         if not len(name) <= 20:  # Length check
             return -1
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (user,)
-        ) as cursor:  # Make sure the user doesn't have any other devices with the same name added
-            try:
-                devices = ujson.loads((await cursor.fetchone())[0])
-            except:
-                return 0
-
-        if any(x['name'] == name.lower() for x in devices):
+        if (
+            await self.bot.db.fetchone(
+                'SELECT 1 FROM devices WHERE user = ? AND LOWER(name) = ?',
+                (user, name.lower()),
+            )
+            is not None
+        ):  # Make sure the user doesn't have any other devices with the same name added
             return -2
 
         return 0
@@ -144,34 +199,266 @@ class UtilsCog(commands.Cog, name='Utilities'):
 
         return gen_hash == apnonce
 
+    # Database functions
+    async def _get_devices(self, where: str, params: tuple) -> list[dict]:
+        devices = {
+            row[0]: dict(zip(DEVICE_COLUMNS, row)) | {'saved_blobs': list()}
+            for row in await self.bot.db.fetchall(
+                f'''
+                SELECT devices.id, devices.user, devices.name, devices.identifier, devices.ecid,
+                devices.boardconfig, devices.generator, devices.apnonce
+                FROM devices INNER JOIN users ON devices.user = users.user
+                WHERE {where} ORDER BY devices.id
+                ''',
+                params,
+            )
+        }
+
+        for device, version, buildid in await self.bot.db.fetchall(
+            f'''
+            SELECT saved_blobs.device, saved_blobs.version, saved_blobs.buildid
+            FROM saved_blobs INNER JOIN devices ON saved_blobs.device = devices.id
+            INNER JOIN users ON devices.user = users.user
+            WHERE {where}
+            ''',
+            params,
+        ):
+            if device in devices.keys():  # Device may have been added between queries
+                devices[device]['saved_blobs'].append(
+                    {'version': version, 'buildid': buildid}
+                )
+
+        return list(devices.values())
+
+    async def get_devices(self, user: int) -> list[dict]:
+        return await self._get_devices('users.user = ?', (user,))
+
+    async def get_enabled_devices(self) -> dict[int, list[dict]]:
+        users = dict()
+        for device in await self._get_devices('users.enabled = ?', (True,)):
+            users.setdefault(device['user'], list()).append(device)
+
+        return users
+
+    async def count_devices(self, *, enabled: bool = None) -> int:
+        if enabled is None:
+            sql, params = 'SELECT COUNT(*) FROM devices', ()
+        else:
+            sql = 'SELECT COUNT(*) FROM devices INNER JOIN users ON devices.user = users.user WHERE users.enabled = ?'
+            params = (enabled,)
+
+        return (await self.bot.db.fetchone(sql, params))[0]
+
+    async def load_device_count(self) -> int:
+        self.device_count = await self.count_devices(enabled=True)
+        return self.device_count
+
+    async def load_registered_users(self) -> None:
+        self.registered_users = {
+            row[0] for row in await self.bot.db.fetchall('SELECT user FROM users')
+        }
+
+    async def _get_user_state(self, user: int) -> Optional[tuple[bool, int]]:
+        return (await self._get_user_states([user])).get(user)
+
+    async def _get_user_states(
+        self, users: Iterable[int]
+    ) -> dict[int, tuple[bool, int]]:
+        users = list(users)
+        states = dict()
+        for i in range(0, len(users), SQL_BATCH_SIZE):
+            batch = users[i : i + SQL_BATCH_SIZE]
+            for user, enabled, num_devices in await self.bot.db.fetchall(
+                f"SELECT user, enabled, (SELECT COUNT(*) FROM devices WHERE devices.user = users.user) FROM users WHERE user IN ({','.join('?' * len(batch))})",
+                batch,
+            ):
+                states[user] = (bool(enabled), num_devices)
+
+        return states
+
+    async def add_device(self, user: int, device: dict) -> bool:
+        state = await self._get_user_state(user)
+        if (
+            state is not None and state[0] == False
+        ):  # Adding a device re-enables the user's other devices
+            self.device_count += state[1]
+
+        await self.bot.db.execute(
+            'INSERT INTO users(user, enabled) VALUES(?,?) ON CONFLICT(user) DO UPDATE SET enabled = excluded.enabled',
+            (user, True),
+        )
+        cursor = await self.bot.db.execute(
+            'INSERT OR IGNORE INTO devices(user, name, identifier, ecid, boardconfig, generator, apnonce) VALUES(?,?,?,?,?,?,?)',
+            (
+                user,
+                device['name'],
+                device['identifier'],
+                device['ecid'],
+                device['boardconfig'],
+                device['generator'],
+                device['apnonce'],
+            ),
+        )
+        if (
+            cursor.rowcount == 0
+        ):  # The ECID was added by someone else since it was checked
+            await self.bot.db.execute(
+                'DELETE FROM users WHERE user = ? AND NOT EXISTS (SELECT 1 FROM devices WHERE devices.user = users.user)',
+                (user,),
+            )
+            await self.bot.db.commit()
+            return False
+
+        device['id'] = cursor.lastrowid
+        device['user'] = user
+        await self.bot.db.commit()
+
+        self.device_count += 1
+        self.registered_users.add(user)
+        return True
+
+    async def remove_device(self, device: dict) -> None:
+        state = await self._get_user_state(device['user'])
+        await self.bot.db.execute(
+            'DELETE FROM devices WHERE id = ?', (device['id'],)
+        )  # Saved blobs are removed along with the device
+        await self.bot.db.execute(
+            'DELETE FROM users WHERE user = ? AND NOT EXISTS (SELECT 1 FROM devices WHERE devices.user = users.user)',
+            (device['user'],),
+        )
+        await self.bot.db.commit()
+
+        if state is not None and state[0] == True:
+            self.device_count -= 1
+
+        # The user is removed along with their last device
+        if state is None or state[1] <= 1:
+            self.registered_users.discard(device['user'])
+
+    def queue_user_enabled(self, user: int, enabled: bool) -> None:
+        self._user_updates[user] = enabled  # Only the latest event for a user matters
+        if self._user_updates_flush is None or self._user_updates_flush.done():
+            self._user_updates_flush = asyncio.create_task(self._flush_user_updates())
+            self._user_updates_flush.add_done_callback(self._log_task_error)
+
+    async def _flush_user_updates(self) -> None:
+        # Events queued while the last batch was being written go in the next one
+        while len(self._user_updates) > 0:
+            await asyncio.sleep(MEMBER_BATCH_DELAY)
+
+            updates, self._user_updates = self._user_updates, dict()
+            states = await self._get_user_states(updates.keys())
+            changes = [
+                (enabled, user)
+                for user, enabled in updates.items()
+                if user in states.keys() and states[user][0] != enabled
+            ]
+            if len(changes) == 0:
+                continue
+
+            await self.bot.db.executemany(
+                'UPDATE users SET enabled = ? WHERE user = ?', changes
+            )
+            await self.bot.db.commit()
+
+            for enabled, user in changes:
+                self.device_count += states[user][1] if enabled else -states[user][1]
+
+            enabled = len([change for change in changes if change[0] == True])
+            disabled = len(changes) - enabled
+            self.bot.logger.debug(
+                f"Re-enabled automatic SHSH blob saving for {enabled} user{'s' if enabled != 1 else ''}, disabled for {disabled} user{'s' if disabled != 1 else ''}."
+            )
+
+            await self.update_device_count()
+
+    async def load_blob_index(self) -> None:
+        blobs = await self.bot.db.fetchall(
+            'SELECT ecid, path, name, generator FROM blobs'
+        )
+
+        if len(blobs) == 0:  # Index hasn't been built yet
+            await self.rebuild_blob_index()
+        else:
+            self.blob_index.load(blobs)
+
+    async def rebuild_blob_index(self) -> int:
+        blobs = await asyncio.to_thread(self.blob_index.scan)
+
+        generators = {
+            (ecid, path, name): generator
+            for ecid, path, name, generator in await self.bot.db.fetchall(
+                'SELECT ecid, path, name, generator FROM blobs'
+            )
+        }  # Keep track of which generator saved each blob
+
+        blobs = [
+            (ecid, path, name, generators.get((ecid, path, name)))
+            for ecid, path, name, _ in blobs
+        ]
+
+        await self.bot.db.execute('DELETE FROM blobs')
+        await self.bot.db.executemany(
+            'INSERT INTO blobs(ecid, path, name, generator) VALUES(?,?,?,?)', blobs
+        )
+        await self.bot.db.commit()
+
+        self.blob_index.load(blobs)
+        await self.archive_cache.invalidate()
+        return self.blob_index.total
+
+    async def index_blobs(
+        self, ecid: str, path: str, blobs: dict[str, Optional[str]]
+    ) -> None:
+        await self.bot.db.executemany(
+            'INSERT OR REPLACE INTO blobs(ecid, path, name, generator) VALUES(?,?,?,?)',
+            [(ecid, path, name, generator) for name, generator in blobs.items()],
+        )
+        await self.bot.db.commit()
+
+        self.blob_index.add(ecid, path, blobs)
+        await self.archive_cache.invalidate(ecid)
+
+    async def unindex_blobs(self, ecid: str, path: str = None) -> None:
+        if path is None:
+            await self.bot.db.execute('DELETE FROM blobs WHERE ecid = ?', (ecid,))
+        else:
+            await self.bot.db.execute(
+                'DELETE FROM blobs WHERE ecid = ? AND path = ?', (ecid, path)
+            )
+
+        await self.bot.db.commit()
+
+        self.blob_index.remove(ecid, path)
+        await self.archive_cache.invalidate(ecid)
+
     # Miscellaneous data functions
     def censor_ecid(self, ecid: str) -> str:
         return ('*' * len(ecid))[:-4] + ecid[-4:]
 
     async def get_cpid(self, identifier: str, boardconfig: str) -> str:
-        api = await self.fetch_ipswme_api(identifier)
-        return next(
-            board['cpid']
-            for board in api['boards']
-            if board['boardconfig'].lower() == boardconfig.lower()
-        )
+        return (await self.get_boards(identifier))[boardconfig.lower()]
 
-    async def get_tsschecker_version(self) -> str:
-        args = (
-            'tsschecker'
-            if sys.platform != 'win32'
-            else next(
-                b
-                async for b in aiopath.AsyncPath(__file__).parent.glob(
-                    'tsschecker*.exe'
+    async def get_tsschecker(self) -> str:
+        if self._tsschecker is None:  # Only look up the tsschecker binary once
+            if sys.platform != 'win32':
+                self._tsschecker = (
+                    await asyncio.to_thread(shutil.which, 'tsschecker') or 'tsschecker'
+                )
+            else:
+                self._tsschecker = next(
+                    str(b)
+                    async for b in aiopath.AsyncPath(__file__).parent.glob(
+                        'tsschecker*.exe'
+                    )
+                    if await b.is_file()
                 )
-                if await b.is_file()
-            ),
-            '-h',
-        )
 
+        return self._tsschecker
+
+    async def get_tsschecker_version(self) -> str:
         cmd = await asyncio.create_subprocess_exec(
-            *args, stdout=asyncio.subprocess.PIPE
+            await self.get_tsschecker(), '-h', stdout=asyncio.subprocess.PIPE
         )
         stdout = (await cmd.communicate())[0]
 
@@ -183,10 +470,9 @@ class UtilsCog(commands.Cog, name='Utilities'):
     async def get_whitelist(
         self, guild: int
     ) -> Optional[Union[bool, discord.TextChannel]]:
-        async with self.bot.db.execute(
+        data = await self.bot.db.fetchone(
             'SELECT * FROM whitelist WHERE guild = ?', (guild,)
-        ) as cursor:
-            data = await cursor.fetchone()
+        )
 
         if (data is None) or (data[2] == False):
             return None
@@ -206,41 +492,38 @@ class UtilsCog(commands.Cog, name='Utilities'):
         )
 
     def shsh_count(self, ecid: str = None) -> int:
-        if ecid:
-            shsh_count = len(
-                [
-                    blob
-                    for blob in glob.glob(
-                        str(pathlib.Path(f'Data/Blobs/{ecid}/**/*.shsh*')),
-                        recursive=True,
-                    )
-                ]
-            )
-        else:
-            shsh_count = len(
-                [
-                    blob
-                    for blob in glob.glob(
-                        str(pathlib.Path('Data/Blobs/**/*.shsh*')), recursive=True
-                    )
-                ]
-            )
-
-        return shsh_count
+        return self.blob_index.count(ecid)
 
     async def update_device_count(self) -> None:
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE enabled = ?', (True,)
-        ) as cursor:
-            num_devices = sum(
-                len(ujson.loads(devices[0])) for devices in await cursor.fetchall()
+        # Bursts of device count changes only update the presence once
+        if self._presence_update is None or self._presence_update.done():
+            self._presence_update = asyncio.create_task(self._update_presence())
+            self._presence_update.add_done_callback(self._log_task_error)
+
+    async def _update_presence(self) -> None:
+        while True:
+            await asyncio.sleep(PRESENCE_DELAY)
+            if self.saving_blobs:  # Updated once saving is finished
+                return
+
+            device_count = self.device_count
+            await self.bot.change_presence(
+                activity=discord.Game(
+                    name=f"Saving SHSH blobs for {device_count} device{'s' if device_count != 1 else ''}."
+                )
             )
 
-        await self.bot.change_presence(
-            activity=discord.Game(
-                name=f"Saving SHSH blobs for {num_devices} device{'s' if num_devices != 1 else ''}."
+            if (
+                self.device_count == device_count
+            ):  # Otherwise it changed while the presence was being updated
+                return
+
+    def _log_task_error(self, task: asyncio.Task) -> None:
+        # Background tasks are never awaited, so their errors would go unnoticed
+        if not task.cancelled() and task.exception() is not None:
+            self.bot.logger.warn(
+                f'Background task {task.get_coro().__qualname__} failed: {task.exception()!r}'
             )
-        )
 
     async def whitelist_check(self, ctx: discord.ApplicationContext) -> None:
         if (await ctx.bot.is_owner(ctx.author)) or (
@@ -394,37 +677,107 @@ class UtilsCog(commands.Cog, name='Utilities'):
         return discord.Embed.from_dict(embed)
 
     # SHSH Blob functions
-    async def _get_manifest(
-        self, url: str, path: str
-    ) -> Union[bool, aiopath.AsyncPath]:
+    async def _fetch_manifest(self, url: str) -> Optional[bytes]:
         async with self.bot.session.get(
             f"{'/'.join(url.split('/')[:-1])}/BuildManifest.plist"
         ) as resp:
             if resp.status == 200:
-                manifest = await resp.read()
-            else:
-                return False
+                return await resp.read()
 
-        manifest_path = pathlib.Path(path) / 'manifest.plist'
-        with manifest_path.open('wb') as f:
-            f.write(manifest)
+        try:  # Fall back to extracting the manifest from the IPSW itself
+            return await self.remote_zip.read_member(url, 'BuildManifest')
+        except (RemoteZipError, aiohttp.ClientError, asyncio.TimeoutError):
+            return None
 
-        return aiopath.AsyncPath(manifest_path)
+    async def _fetch_verified_manifest(self, firm: dict) -> Optional[bytes]:
+        manifest = await self._fetch_manifest(firm['url'])
+        if manifest is None:
+            return None
 
-    def _sync_get_manifest(self, url: str, path: str) -> Union[bool, aiopath.AsyncPath]:
         try:
-            with remotezip.RemoteZip(url) as ipsw:
-                manifest = ipsw.read(
-                    next(f for f in ipsw.namelist() if 'BuildManifest' in f)
-                )
-        except (remotezip.RemoteIOError, StopIteration):
-            return False
+            buildid = (await asyncio.to_thread(plistlib.loads, manifest)).get(
+                'ProductBuildVersion'
+            )
+        except (
+            plistlib.InvalidFileException,
+            ValueError,
+            ExpatError,
+            AttributeError,
+        ):  # Truncated or malformed manifest
+            buildid = None
+
+        if (
+            str(buildid).lower() != firm['buildid'].lower()
+        ):  # Don't cache a broken or mismatched manifest
+            self.bot.logger.warn(
+                f"Invalid BuildManifest for {firm['version']} ({firm['buildid']}): {firm['url']}"
+            )
+            return None
+
+        return manifest
 
+    async def prefetch_manifests(self, firms: list[dict]) -> tuple[int, int]:
+        async def _prefetch(firm: dict) -> bool:
+            async with self.api_sem:
+                try:
+                    return (
+                        await self.manifest_cache.get(
+                            firm['url'], lambda _: self._fetch_verified_manifest(firm)
+                        )
+                        is not None
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    return False
+
+        firms = list({firm['url']: firm for firm in firms}.values())
+        prefetched = await asyncio.gather(*[_prefetch(firm) for firm in firms])
+        return sum(prefetched), len(firms)
+
+    async def get_manifest(self, firm: dict, path: str) -> Optional[aiopath.AsyncPath]:
         manifest_path = pathlib.Path(path) / 'manifest.plist'
-        with manifest_path.open('wb') as f:
-            f.write(manifest)
+        for _ in range(2):
+            cached = await self.manifest_cache.get(
+                firm['url'], lambda _: self._fetch_verified_manifest(firm)
+            )
+            if cached is None:
+                return None
+
+            try:  # Link the cached manifest so it can't be evicted while tsschecker uses it
+                try:
+                    await asyncio.to_thread(os.link, cached, manifest_path)
+                except FileNotFoundError:
+                    raise
+                except OSError:
+                    await asyncio.to_thread(shutil.copyfile, cached, manifest_path)
+
+            except FileNotFoundError:  # Evicted before it could be linked, fetch it again
+                await self.manifest_cache.invalidate(firm['url'])
+                continue
+
+            return aiopath.AsyncPath(manifest_path)
+
+    async def _run_tsschecker(self, user: int, *args: str) -> bool:
+        async with self.scheduler.slot(
+            user
+        ):  # Caps the number of tsschecker processes running at once
+            start_time = time.perf_counter()
+            cmd = await asyncio.create_subprocess_exec(
+                await self.get_tsschecker(), *args, stdout=asyncio.subprocess.PIPE
+            )
+            spawn_time = time.perf_counter()
+            stdout = (await cmd.communicate())[0]
 
-        return aiopath.AsyncPath(manifest_path)
+            self.tsschecker_stats['runs'] += 1
+            self.tsschecker_stats['spawn_time'] += spawn_time - start_time
+            self.tsschecker_stats['run_time'] += time.perf_counter() - start_time
+
+        return 'Saved shsh blobs!' in stdout.decode()
+
+    def reset_tsschecker_stats(self) -> dict:
+        stats = self.tsschecker_stats
+        self.tsschecker_stats = {'runs': 0, 'spawn_time': 0, 'run_time': 0}
+
+        return stats
 
     async def _save_blob(
         self, device: dict, firm: dict, manifest: str, tmpdir: aiopath.AsyncPath
@@ -433,15 +786,6 @@ class UtilsCog(commands.Cog, name='Utilities'):
         save_path = ['Data', 'Blobs', device['ecid'], firm['version'], firm['buildid']]
 
         args = [
-            'tsschecker'
-            if sys.platform != 'win32'
-            else next(
-                str(b)
-                async for b in aiopath.AsyncPath(__file__).parent.glob(
-                    'tsschecker*.exe'
-                )
-                if await b.is_file()
-            ),
             '-d',
             device['identifier'],
             '-B',
@@ -450,8 +794,6 @@ class UtilsCog(commands.Cog, name='Utilities'):
             f"0x{device['ecid']}",
             '-m',
             str(manifest),
-            '--save-path',
-            str(tmpdir),
             '-s',
         ]
 
@@ -467,84 +809,294 @@ class UtilsCog(commands.Cog, name='Utilities'):
         if device['generator'] is not None and device['generator'] not in generators:
             generators.append(device['generator'])
 
+        blob_path = '/'.join(save_path[3:])  # Relative to the ECID's directory
         save_path = aiopath.AsyncPath('/'.join(save_path))
+        saved = self.blob_index.get(device['ecid'], blob_path)
         if len(generators) == 0:
-            if len([blob async for blob in save_path.glob('*.shsh*')]) == 1:
+            if len(saved) == 1:
                 return True
 
-            cmd = await asyncio.create_subprocess_exec(
-                *args, stdout=asyncio.subprocess.PIPE
-            )
-            stdout = (await cmd.communicate())[0]
-
-            if 'Saved shsh blobs!' not in stdout.decode():
+            if not await self._run_tsschecker(
+                device['user'], *args, '--save-path', str(tmpdir)
+            ):
                 return False
 
         else:
-            if len([blob async for blob in save_path.glob('*.shsh*')]) == len(
-                generators
-            ):
+            if None in saved.values():  # Blobs saved before generators were recorded
+                if len(saved) == len(generators):
+                    return True
+
+                # There's no way to tell which generators are missing, so start over
+                for blob in saved.keys():
+                    await (save_path / blob).unlink(missing_ok=True)
+
+                await self.unindex_blobs(device['ecid'], blob_path)
+                saved = dict()
+
+            # Only request blobs for generators that haven't been saved yet
+            generators = [gen for gen in generators if gen not in saved.values()]
+            if len(generators) == 0:
                 return True
 
-            elif len([blob async for blob in save_path.glob('*.shsh*')]) > 0:
-                async for blob in save_path.glob('*.shsh*'):
-                    await blob.unlink()
+            async def _save_generator(gen: str, gen_path: aiopath.AsyncPath) -> bool:
+                await gen_path.mkdir()
+                if not await self._run_tsschecker(
+                    device['user'], *args, '--save-path', str(gen_path), '-g', gen
+                ):
+                    return False
 
-            args.append('-g')
-            for gen in generators:
-                args.append(gen)
-                cmd = await asyncio.create_subprocess_exec(
-                    *args, stdout=asyncio.subprocess.PIPE
+                # Keep this generator's blob even if another one fails, so only the
+                # missing generators are requested next time
+                await self._store_blobs(
+                    device['ecid'], blob_path, save_path, gen_path, gen
                 )
-                stdout = (await cmd.communicate())[0]
+                return True
 
-                if 'Saved shsh blobs!' not in stdout.decode():
-                    return False
+            # tsschecker only takes one generator per run, so request every generator at once
+            results = await asyncio.gather(
+                *[
+                    _save_generator(gen, tmpdir / f'gen{i}')
+                    for i, gen in enumerate(generators)
+                ]
+            )
+            return all(results)
 
-                args.pop(-1)
+        await self._store_blobs(device['ecid'], blob_path, save_path, tmpdir, None)
+        return True
 
+    async def _store_blobs(
+        self,
+        ecid: str,
+        blob_path: str,
+        save_path: aiopath.AsyncPath,
+        tmp_path: aiopath.AsyncPath,
+        generator: Optional[str],
+    ) -> None:
         await save_path.mkdir(parents=True, exist_ok=True)
-        async for blob in tmpdir.glob('*.shsh*'):
-            await blob.rename(save_path / blob.name)
 
-        return True
+        blobs = dict()
+        async for blob in tmp_path.glob('*.shsh*'):
+            await blob.rename(save_path / blob.name)
+            blobs[blob.name] = generator
 
-    def _create_tar(self, tmpdir: aiopath.AsyncPath) -> aiopath.AsyncPath:
-        with tarfile.open(tmpdir.parent / 'Blobs.tar.xz', 'w:xz') as tar:
-            tar.add(tmpdir, arcname=tmpdir.name)
+        await self.index_blobs(ecid, blob_path, blobs)
 
     async def backup_blobs(
-        self, tmpdir: aiopath.AsyncPath, *ecids: list[str]
-    ) -> Optional[BytesIO]:
-        blobdir = aiopath.AsyncPath('Data/Blobs')
-        tmpdir = tmpdir / 'SHSH Blobs'
-        await tmpdir.mkdir()
+        self,
+        tmpdir: aiopath.AsyncPath,
+        *ecids: list[str],
+        fmt: str = 'tar.xz',
+        level: Optional[int] = None,
+    ) -> Optional[aiopath.AsyncPath]:
+        archive = tmpdir / f'Blobs.{fmt}'
+        if fmt == 'zip':  # Zip archives can't be assembled from cached fragments
+            if not await asyncio.to_thread(
+                self.archiver.write, archive, ecids, fmt, level
+            ):
+                return
 
-        if len(ecids) == 1:
-            async for firm in blobdir.glob(f'{ecids[0]}/*'):
-                await asyncio.to_thread(shutil.copytree, firm, tmpdir / firm.name)
+            return archive
+
+        layout = 'single' if len(ecids) == 1 else 'multi'
+        if level is None:
+            level = DEFAULT_LEVELS[fmt] or 0
+
+        while True:
+            # Fragments are kept in the cache until they've been joined together
+            async with self.archive_cache.fragments(
+                ecids, layout, fmt, level
+            ) as fragments:
+                if len(fragments) == 0:
+                    return
 
-        else:
-            for ecid in ecids:
                 try:
                     await asyncio.to_thread(
-                        shutil.copytree, blobdir / ecid, tmpdir / ecid
+                        self.archiver.concat, archive, fragments, fmt, level
                     )
-                except FileNotFoundError:
-                    pass
+                except FileNotFoundError:  # A fragment was invalidated, so rebuild it
+                    continue
+
+            return archive
+
+    async def send_archive(
+        self,
+        ctx: discord.ApplicationContext,
+        embed: discord.Embed,
+        archive: aiopath.AsyncPath,
+        filename: str,
+    ) -> None:
+        limit = ctx.guild.filesize_limit if ctx.guild is not None else UPLOAD_LIMIT
+        parts = await asyncio.to_thread(self.archiver.split, archive, limit)
+        if len(parts) > 1:
+            embed.description += f'\n*Split into {len(parts)} parts, join them with `cat` before extracting.*'
+
+        # Parts are uploaded one at a time, so only one is ever being sent
+        for i, part in enumerate(parts):
+            file = discord.File(
+                fp=str(part),
+                filename=filename if len(parts) == 1 else f'{filename}.{i + 1:03}',
+            )
+            if i == 0:
+                await ctx.edit(embed=embed, file=file)
+            else:
+                await ctx.followup.send(file=file, ephemeral=True)
+
+    async def _fetch_json(
+        self, url: str, *, optional: bool = False
+    ) -> Optional[Union[dict, list]]:
+        cached = await self.http_cache.get(url)
+
+        status = None
+        for attempt in range(API_RETRIES + 1):
+            if attempt > 0:  # Exponential backoff between retries
+                await asyncio.sleep(API_BACKOFF * 2 ** (attempt - 1))
+
+            try:
+                async with self.bot.session.get(
+                    url, headers=self.http_cache.headers(cached), timeout=API_TIMEOUT
+                ) as resp:
+                    if (
+                        resp.status == 304 and cached is not None
+                    ):  # Response hasn't changed since we last fetched it
+                        return cached['data']
+
+                    elif resp.status == 200:
+                        data = await resp.json()
+                        if data is not None:  # Don't cache an empty body
+                            await self.http_cache.store(url, resp.headers, data)
+                            return data
+
+                    status = resp.status
+            except ValueError:  # Malformed JSON body
+                status = resp.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt < API_RETRIES:
+                    continue
+                elif optional:
+                    return None
+
+                raise
+
+            if (
+                status != 200 and status not in API_RETRY_STATUSES
+            ):  # Bad 200 responses are retried as well
+                break
+
+        if optional:
+            return None
+
+        raise APIError(url, status)
+
+    async def _get_device_catalog(self) -> dict[str, dict[str, int]]:
+        return {
+            device['identifier']: {
+                board['boardconfig'].lower(): board['cpid']
+                for board in device.get('boards', list())
+            }
+            for device in await self._fetch_json(f'{API_URL}/devices')
+        }
 
-        if len([blob async for blob in tmpdir.glob('*/') if await blob.is_dir()]) == 0:
+    async def get_device_catalog(
+        self, *, refresh: bool = False
+    ) -> dict[str, dict[str, int]]:
+        return await self.catalog_cache.get(
+            'devices', self._get_device_catalog, refresh=refresh
+        )
+
+    async def get_boards(self, identifier: str) -> dict[str, int]:
+        boards = (await self.get_device_catalog()).get(identifier)
+        if boards:
+            return boards
+
+        api = await self.fetch_ipswme_api(
+            identifier
+        )  # Device isn't in the catalog yet or has no boards listed there
+        return {board['boardconfig'].lower(): board['cpid'] for board in api['boards']}
+
+    async def fetch_ipswme_api(self, identifier: str, *, refresh: bool = False) -> dict:
+        return await self.api_cache.get(
+            identifier,
+            lambda: self._fetch_json(f'{API_URL}/device/{identifier}'),
+            refresh=refresh,
+        )
+
+    def diff_firms(self, old: dict[str, list], new: dict[str, list]) -> dict[str, list]:
+        changes = dict()
+        for identifier, firms in new.items():
+            if identifier not in old.keys():  # New devices have nothing to compare to
+                continue
+
+            signed = [f['buildid'] for f in old[identifier] if f['signed'] == True]
+            changed = [
+                firm
+                for firm in firms
+                if firm['signed'] == True and firm['buildid'] not in signed
+            ]  # Firmwares that were just released or resigned
+
+            if len(changed) > 0:
+                changes[identifier] = changed
+
+        return changes
+
+    async def load_firm_state(self) -> dict[str, list]:
+        firms = dict()
+        for identifier, version, buildid, url, signed in await self.bot.db.fetchall(
+            'SELECT identifier, version, buildid, url, signed FROM firmwares'
+        ):
+            firms.setdefault(identifier, list()).append(
+                {
+                    'version': version,
+                    'buildid': buildid,
+                    'url': url,
+                    'signed': bool(signed),
+                }
+            )
+
+        return firms
+
+    async def save_firm_state(self, firms: dict[str, list]) -> None:
+        if len(firms) == 0:
             return
 
-        await asyncio.to_thread(self._create_tar, tmpdir)
-        return BytesIO(await (tmpdir.parent / 'Blobs.tar.xz').read_bytes())
+        await self.bot.db.executemany(
+            'DELETE FROM firmwares WHERE identifier = ?',
+            [(identifier,) for identifier in firms.keys()],
+        )
+        await self.bot.db.executemany(
+            'INSERT INTO firmwares(identifier, version, buildid, url, signed) VALUES(?,?,?,?,?)',
+            [
+                (identifier, f['version'], f['buildid'], f['url'], f['signed'])
+                for identifier in firms.keys()
+                for f in firms[identifier]
+            ],
+        )
+        await self.bot.db.commit()
 
-    async def fetch_ipswme_api(self, identifier: str) -> dict:
-        async with self.bot.session.get(f'{API_URL}/device/{identifier}') as resp:
-            return await resp.json()
+    async def get_all_firms(self, identifiers: list[str]) -> dict[str, list]:
+        async def _get_firms(identifier: str) -> tuple[str, Optional[list]]:
+            async with self.api_sem:
+                try:
+                    return identifier, await self.get_firms(identifier, refresh=True)
+                except (APIError, aiohttp.ClientError, asyncio.TimeoutError):
+                    return identifier, None
+
+        return {
+            identifier: firms
+            for identifier, firms in await asyncio.gather(
+                *[_get_firms(identifier) for identifier in identifiers]
+            )
+            if firms is not None
+        }
+
+    async def get_firms(self, identifier: str, *, refresh: bool = False) -> list:
+        return await self.firm_cache.get(
+            identifier,
+            lambda: self._get_firms(identifier, refresh=refresh),
+            refresh=refresh,
+        )
 
-    async def get_firms(self, identifier: str) -> list:
-        api = await self.fetch_ipswme_api(identifier)
+    async def _get_firms(self, identifier: str, *, refresh: bool = False) -> list:
+        api = await self.fetch_ipswme_api(identifier, refresh=refresh)
 
         buildids = list()
         for firm in api['firmwares']:
@@ -557,11 +1109,9 @@ class UtilsCog(commands.Cog, name='Utilities'):
                 }
             )
 
-        async with self.bot.session.get(f'{BETA_API_URL}/{identifier}') as resp:
-            if resp.status != 200:
-                return buildids
-            else:
-                beta_api = await resp.json()
+        beta_api = await self._fetch_json(f'{BETA_API_URL}/{identifier}', optional=True)
+        if beta_api is None:
+            return buildids
 
         for firm in beta_api:
             if any(firm['buildid'] == f['buildid'] for f in buildids):
@@ -596,14 +1146,10 @@ class UtilsCog(commands.Cog, name='Utilities'):
                 continue
 
             async with aiofiles.tempfile.TemporaryDirectory() as tmpdir:
-                manifest = await self._get_manifest(
-                    firm['url'], tmpdir
-                ) or await asyncio.to_thread(
-                    self._sync_get_manifest, firm['url'], tmpdir
-                )
+                manifest = await self.get_manifest(firm, tmpdir)
                 saved_blob = (
                     await self._save_blob(device, firm, str(manifest), manifest.parent)
-                    if manifest != False
+                    if manifest is not None
                     else False
                 )
 
@@ -611,6 +1157,7 @@ class UtilsCog(commands.Cog, name='Utilities'):
                 device['saved_blobs'].append(
                     {x: y for x, y in firm.items() if x not in ('url', 'signed')}
                 )
+                await self.record_saved_blob(device, firm)
                 stats['saved_blobs'].append(firm)
             else:
                 stats['failed_blobs'].append(firm)
@@ -619,15 +1166,65 @@ class UtilsCog(commands.Cog, name='Utilities'):
 
         return stats
 
-    async def save_user_blobs(self, user: int, devices: list[dict]) -> None:
-        tasks = [self.save_device_blobs(device) for device in devices]
-        data = await asyncio.gather(*tasks)
+    async def record_saved_blob(self, device: dict, firm: dict) -> None:
+        self._saved_blobs_queue.append((firm['version'], firm['buildid'], device['id']))
+        if len(self._saved_blobs_queue) >= SAVED_BLOBS_BATCH_SIZE:
+            await self.flush_saved_blobs()
 
-        await self.bot.db.execute(
-            'UPDATE autotss SET devices = ? WHERE user = ?',
-            (ujson.dumps([d['device'] for d in data]), user),
+        elif self._saved_blobs_flush is None or self._saved_blobs_flush.done():
+            self._saved_blobs_flush = asyncio.create_task(self._delayed_flush())
+            self._saved_blobs_flush.add_done_callback(self._log_task_error)
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(SAVED_BLOBS_BATCH_DELAY)
+        await self.flush_saved_blobs()
+
+    async def flush_saved_blobs(self) -> None:
+        if len(self._saved_blobs_queue) == 0:
+            return
+
+        saved_blobs, self._saved_blobs_queue = self._saved_blobs_queue, list()
+        try:
+            await self.bot.db.executemany(
+                'INSERT OR IGNORE INTO saved_blobs(device, version, buildid) SELECT id, ?, ? FROM devices WHERE id = ?',
+                saved_blobs,
+            )  # Skip devices that were removed while their blobs were being saved
+            await self.bot.db.commit()
+        except:
+            # Put the batch back, so it's written with the next one
+            self._saved_blobs_queue[:0] = saved_blobs
+            raise
+
+    def missing_signed_blobs(self, device: dict, firms: dict[str, list]) -> bool:
+        saved = {firm['buildid'] for firm in device['saved_blobs']}
+        return any(
+            firm['signed'] == True and firm['buildid'] not in saved
+            for firm in firms.get(device['identifier'], list())
         )
-        await self.bot.db.commit()
+
+    async def save_user_blobs(
+        self,
+        user: int,
+        devices: list[dict],
+        identifiers: Iterable[str] = None,
+        firms: dict[str, list] = None,
+    ) -> None:
+        async def _skip_device(device: dict) -> dict:
+            return {'saved_blobs': list(), 'failed_blobs': list(), 'device': device}
+
+        tasks = [
+            self.save_device_blobs(device)
+            if identifiers is None
+            or device['identifier'] in identifiers
+            or len(device['saved_blobs']) == 0  # Devices that were just added
+            or (
+                firms is not None and self.missing_signed_blobs(device, firms)
+            )  # Retry failed saves and devices that were re-enabled
+            else _skip_device(device)
+            for device in devices
+        ]
+        data = await asyncio.gather(*tasks)
+        await self.flush_saved_blobs()
 
         user_stats = {
             'blobs_saved': sum([len(d['saved_blobs']) for d in data]),
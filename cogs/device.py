@@ -11,7 +11,6 @@ import aiofiles
 import aiopath
 import asyncio
 import discord
-import ujson
 import shutil
 import textwrap
 
@@ -40,13 +39,7 @@ class DeviceCog(commands.Cog, name='Device'):
         ctx: discord.ApplicationContext,
         name: Option(str, description='Name for device'),
     ) -> None:
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (ctx.author.id,)
-        ) as cursor:
-            try:
-                devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                devices = list()
+        devices = await self.utils.get_devices(ctx.author.id)
 
         if (len(devices) >= self.bot.max_devices) and (
             await self.bot.is_owner(ctx.author) == False
@@ -194,18 +187,10 @@ class DeviceCog(commands.Cog, name='Device'):
         device['saved_blobs'] = list()
 
         # Add device information into the database
-        devices.append(device)
-
-        async with self.bot.db.execute(
-            'SELECT devices FROM autotss WHERE user = ?', (ctx.author.id,)
-        ) as cursor:
-            if await cursor.fetchone() is None:
-                sql = 'INSERT INTO autotss(devices, enabled, user) VALUES(?,?,?)'
-            else:
-                sql = 'UPDATE autotss SET devices = ?, enabled = ? WHERE user = ?'
-
-        await self.bot.db.execute(sql, (ujson.dumps(devices), True, ctx.author.id))
-        await self.bot.db.commit()
+        if await self.utils.add_device(ctx.author.id, device) is False:
+            raise commands.BadArgument(
+                'Invalid device ECID provided. This ECID has already been added to AutoTSS.'
+            )
 
         embed = discord.Embed(
             title='Add Device',
@@ -227,13 +212,7 @@ class DeviceCog(commands.Cog, name='Device'):
     async def remove_device(self, ctx: discord.ApplicationContext) -> None:
         await ctx.defer(ephemeral=True)
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (ctx.author.id,)
-        ) as cursor:
-            try:
-                devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                devices = list()
+        devices = await self.utils.get_devices(ctx.author.id)
 
         if len(devices) == 0:
             raise NoDevicesFound(ctx.author)
@@ -310,48 +289,35 @@ class DeviceCog(commands.Cog, name='Device'):
                 aiopath.AsyncPath(tmpdir), devices[num]['ecid']
             )
 
-        if tar is not None:
-            await asyncio.to_thread(
-                shutil.rmtree,
-                aiopath.AsyncPath(f"Data/Blobs/{devices[num]['ecid']}"),
-            )
+            if tar is not None:
+                await asyncio.to_thread(
+                    shutil.rmtree,
+                    aiopath.AsyncPath(f"Data/Blobs/{devices[num]['ecid']}"),
+                )
 
-            embed = discord.Embed(
-                title='Remove Device',
-                description=f"Device `{devices[num]['name']}` removed.\nSHSH Blobs:",
-            )
-            await ctx.edit(
-                embed=embed, file=discord.File(fp=tar, filename='SHSH Blobs.tar.xz')
-            )
+                embed = discord.Embed(
+                    title='Remove Device',
+                    description=f"Device `{devices[num]['name']}` removed.\nSHSH Blobs:",
+                )
+                await self.utils.send_archive(ctx, embed, tar, 'SHSH Blobs.tar.xz')
 
-        else:
-            embed = discord.Embed(
-                title='Remove Device',
-                description=f"Device `{devices[num]['name']}` removed.",
-            )
-            embed.set_footer(
-                text=ctx.author.display_name,
-                icon_url=ctx.author.display_avatar.with_static_format('png').url,
-            )
-            await ctx.edit(embed=embed)
+            else:
+                embed = discord.Embed(
+                    title='Remove Device',
+                    description=f"Device `{devices[num]['name']}` removed.",
+                )
+                embed.set_footer(
+                    text=ctx.author.display_name,
+                    icon_url=ctx.author.display_avatar.with_static_format('png').url,
+                )
+                await ctx.edit(embed=embed)
 
         self.bot.logger.info(
             f"User: `@{ctx.author}` has removed device: `{devices[num]['name']}`"
         )
 
-        devices.pop(num)
-
-        if len(devices) == 0:
-            await self.bot.db.execute(
-                'DELETE FROM autotss WHERE user = ?', (ctx.author.id,)
-            )
-        else:
-            await self.bot.db.execute(
-                'UPDATE autotss SET devices = ? WHERE user = ?',
-                (ujson.dumps(devices), ctx.author.id),
-            )
-
-        await self.bot.db.commit()
+        await self.utils.remove_device(devices[num])
+        await self.utils.unindex_blobs(devices[num]['ecid'])
 
         await self.utils.update_device_count()
 
@@ -370,13 +336,7 @@ class DeviceCog(commands.Cog, name='Device'):
         if user is None:
             user = ctx.author
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (user.id,)
-        ) as cursor:
-            try:
-                devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                devices = list()
+        devices = await self.utils.get_devices(user.id)
 
         if len(devices) == 0:
             raise NoDevicesFound(user)
@@ -385,9 +345,7 @@ class DeviceCog(commands.Cog, name='Device'):
         for device in devices:
             num_blobs = ','.join(
                 textwrap.wrap(
-                    str(await asyncio.to_thread(self.utils.shsh_count, device['ecid']))[
-                        ::-1
-                    ],
+                    str(self.utils.shsh_count(device['ecid']))[::-1],
                     3,
                 )
             )[::-1]
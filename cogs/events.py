@@ -3,7 +3,6 @@ from discord.ext import commands, tasks
 
 import asyncio
 import discord
-import ujson
 import time
 
 
@@ -19,110 +18,150 @@ class EventsCog(commands.Cog, name='Events'):
         await self.bot.wait_until_ready()
 
         self.bot.logger.info('Auto blob saver started.')
-        async with self.bot.session.get('https://api.ipsw.me/v4/devices') as resp:
-            self.bot.logger.debug('Fetched device identifiers from IPSW.me.')
-            devices = [
-                d
-                for d in await resp.json()
-                if any(
-                    d['identifier'].startswith(x)
-                    for x in ('iPhone', 'AppleTV', 'iPod', 'iPad')
-                )
-            ]
+        identifiers = [
+            identifier
+            for identifier in await self.utils.get_device_catalog()
+            if any(
+                identifier.startswith(x) for x in ('iPhone', 'AppleTV', 'iPod', 'iPad')
+            )
+        ]
+        self.bot.logger.debug('Fetched device identifiers from the device catalog.')
 
         self.bot.logger.debug('Fetching all signed firmwares.')
 
-        api = dict()
-        for device in [d['identifier'] for d in devices]:
-            api[device] = await self.utils.get_firms(device)
+        start_time = await asyncio.to_thread(time.time)
+        api = await self.utils.get_all_firms(identifiers)
+        poll_time = round(await asyncio.to_thread(time.time) - start_time, 2)
+
+        self.bot.logger.info(
+            f"Fetched firmwares for {len(api)}/{len(identifiers)} device{'s' if len(identifiers) != 1 else ''} in {poll_time} seconds."
+        )
+        if len(api) < len(identifiers):
+            self.bot.logger.warn(
+                f'Failed to fetch firmwares for {len(identifiers) - len(api)} device(s), skipping them this cycle.'
+            )
 
         try:
             self._api
         except AttributeError:
-            self.bot.logger.warn(
-                'No firmware cache found, storing current firmwares as cache and restarting.',
-            )
-            self._api = api
-            return
+            self._api = await self.utils.load_firm_state()
+            if len(self._api) == 0:
+                self.bot.logger.warn(
+                    'No firmware cache found, storing current firmwares as cache and restarting.',
+                )
+                self._api = api
+                await self.utils.save_firm_state(api)
+                return
+
+            self.bot.logger.debug('Loaded firmware cache from the database.')
 
         if self.utils.saving_blobs:
             self.bot.logger.info('SHSH blob saver already running, sleeping for 5m.')
             await asyncio.sleep(300)
             return
 
+        changes = self.utils.diff_firms(self._api, api)
+        for device in api.keys():
+            if device not in self._api.keys():  # If new device is added to the API
+                self.bot.logger.debug(f'New device has been detected: {device}.')
+
+        for device, firms in changes.items():
+            firm_type = 'iOS' if 'AppleTV' not in device else 'tvOS'
+            for firm in firms:
+                if any(
+                    oldfirm['buildid'] == firm['buildid']
+                    for oldfirm in self._api[device]
+                ):  # If firmware has been resigned
+                    self.bot.logger.debug(
+                        f"{firm_type} {firm['version']} ({firm['buildid']}) has been resigned for {device}, saving SHSH blobs."
+                    )
+                else:  # If firmware was just released
+                    self.bot.logger.debug(
+                        f"{firm_type} {firm['version']} ({firm['buildid']}) has been released for {device}, saving SHSH blobs."
+                    )
+
         self.bot.logger.debug('Manual SHSH blob saving is now disabled.')
         self.utils.saving_blobs = True
         await self.bot.change_presence(
             activity=discord.Game(name='Currently saving SHSH blobs!')
         )
 
-        description = None
-        for device in api.keys():
-            if device not in self._api.keys():  # If new device is added to the API
-                self.bot.logger.debug(f'New device has been detected: {device}.')
-                self._api[device] = api[device]
-                continue
+        new_firms = [firm for firms in changes.values() for firm in firms]
+        if len(new_firms) > 0:
+            self.bot.logger.debug('Prefetching BuildManifests for new firmwares.')
+            prefetched, manifests = await self.utils.prefetch_manifests(new_firms)
+            self.bot.logger.debug(
+                f"Prefetched {prefetched}/{manifests} BuildManifest{'s' if manifests != 1 else ''}."
+            )
 
-            firm_type = 'iOS' if 'AppleTV' not in device else 'tvOS'
-            for firm in api[device]:
-                if firm['signed'] == True:
-                    if firm not in self._api[device]:  # If firmware was just released
-                        self.bot.logger.debug(
-                            f"{firm_type} {firm['version']} ({firm['buildid']}) has been released, saving SHSH blobs."
-                        )
-
-                    elif any(
-                        oldfirm['signed'] == False
-                        for oldfirm in self._api[device]
-                        if oldfirm['buildid'] == firm['buildid']
-                    ):  # If firmware has been resigned
-                        self.bot.logger.debug(
-                            f"{firm_type} {firm['version']} ({firm['buildid']}) has been resigned for {device}, saving SHSH blobs."
-                        )
-
-                    self.bot.logger.debug('Saving SHSH Blobs.')
-
-                    async with self.bot.db.execute(
-                        'SELECT * from autotss WHERE enabled = ?', (True,)
-                    ) as cursor:
-                        data = await cursor.fetchall()
-
-                    start_time = await asyncio.to_thread(time.time)
-                    data = await asyncio.gather(
-                        *[
-                            self.utils.sem_call(
-                                self.utils.save_user_blobs,
-                                user_data[0],
-                                ujson.loads(user_data[1]),
-                            )
-                            for user_data in data
-                        ]
-                    )
-                    finish_time = round(await asyncio.to_thread(time.time) - start_time)
+        self.bot.logger.debug('Saving SHSH Blobs.')
+
+        data = await self.utils.get_enabled_devices()
 
-                    blobs_saved = sum(user['blobs_saved'] for user in data)
-                    devices_saved = sum(user['devices_saved'] for user in data)
+        # Correct any drift in the cached device count
+        self.utils.device_count = sum(len(devices) for devices in data.values())
 
-                    if blobs_saved > 0:
-                        description = ' '.join(
-                            (
-                                f"Saved {blobs_saved} SHSH blob{'s' if blobs_saved > 1 else ''}",
-                                f"for {devices_saved} device{'s' if devices_saved > 1 else ''}",
-                                f"in {finish_time} second{'s' if finish_time != 1 else ''}.",
-                            )
-                        )
+        start_time = await asyncio.to_thread(time.time)
+        data = await asyncio.gather(
+            *[
+                self.utils.sem_call(
+                    self.utils.save_user_blobs, user, devices, changes.keys(), api
+                )
+                for user, devices in data.items()
+            ]
+        )
+        finish_time = round(await asyncio.to_thread(time.time) - start_time)
+
+        # Only store the new firmwares once the sweep is done, so an interrupted sweep
+        # is picked up again after a restart
+        await self.utils.save_firm_state(
+            {
+                device: firms
+                for device, firms in api.items()
+                if self._api.get(device) != firms
+            }
+        )
+        self._api.update(api)
 
-                    else:
-                        description = 'All SHSH blobs have already been saved.'
+        blobs_saved = sum(user['blobs_saved'] for user in data)
+        devices_saved = sum(user['devices_saved'] for user in data)
 
-                    break
+        if blobs_saved > 0:
+            description = ' '.join(
+                (
+                    f"Saved {blobs_saved} SHSH blob{'s' if blobs_saved > 1 else ''}",
+                    f"for {devices_saved} device{'s' if devices_saved > 1 else ''}",
+                    f"in {finish_time} second{'s' if finish_time != 1 else ''}.",
+                )
+            )
 
-            else:
-                self._api[device] = api[device]
+        else:
+            description = 'All SHSH blobs have already been saved.'
 
-            if description is not None:
-                self.bot.logger.info(description)
-                break
+        self.bot.logger.info(description)
+
+        stats = self.utils.reset_tsschecker_stats()
+        if stats['runs'] > 0:
+            self.bot.logger.debug(
+                ' '.join(
+                    (
+                        f"Ran tsschecker {stats['runs']} time{'s' if stats['runs'] != 1 else ''},",
+                        f"averaging {round(stats['spawn_time'] / stats['runs'] * 1000, 2)}ms of process spawn overhead",
+                        f"and {round(stats['run_time'] / stats['runs'], 2)}s total per blob.",
+                    )
+                )
+            )
+
+        self.bot.logger.debug(
+            f'tsschecker queue: {self.utils.scheduler.queued} waiting, average wait of {round(self.utils.scheduler.average_wait, 2)}s.'
+        )
+        self.utils.scheduler.reset_stats()
+
+        if self.bot.db.commits > 0:
+            self.bot.logger.debug(
+                f'Database: {self.bot.db.commit_requests} commits coalesced into {self.bot.db.commits} transactions, averaging {round(self.bot.db.average_commit_time * 1000, 2)}ms (max {round(self.bot.db.max_commit_time * 1000, 2)}ms).'
+            )
+        self.bot.db.reset_stats()
 
         self.bot.logger.info('Auto blob saver finished.')
 
@@ -154,43 +193,23 @@ class EventsCog(commands.Cog, name='Events'):
     async def on_member_join(self, member: discord.Member) -> None:
         await self.bot.wait_until_ready()
 
-        async with self.bot.db.execute(
-            'SELECT * from autotss WHERE user = ?', (member.id,)
-        ) as cursor:
-            if await cursor.fetchone() is None:
-                return
+        if member.id not in self.utils.registered_users:
+            return
 
+        # Written in batches along with other member events
         if len(member.mutual_guilds) == 0:
-            await self.bot.db.execute(
-                'UPDATE autotss SET enabled = ? WHERE user = ?', (True, member.id)
-            )
-            await self.bot.db.commit()
-            self.bot.logger.debug(
-                f'Re-enabled automatic SHSH blob saving for {member.name}#{member.discriminator}.'
-            )
-
-        await self.utils.update_device_count()
+            self.utils.queue_user_enabled(member.id, True)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member) -> None:
         await self.bot.wait_until_ready()
 
-        async with self.bot.db.execute(
-            'SELECT * from autotss WHERE user = ?', (member.id,)
-        ) as cursor:
-            if await cursor.fetchone() is None:
-                return
+        if member.id not in self.utils.registered_users:
+            return
 
+        # Written in batches along with other member events
         if len(member.mutual_guilds) == 0:
-            await self.bot.db.execute(
-                'UPDATE autotss SET enabled = ? WHERE user = ?', (False, member.id)
-            )
-            await self.bot.db.commit()
-            self.bot.logger.debug(
-                f'Disabled automatic SHSH blob saving for {member.name}#{member.discriminator}.'
-            )
-
-        await self.utils.update_device_count()
+            self.utils.queue_user_enabled(member.id, False)
 
     @commands.Cog.listener()
     async def on_ready(self) -> None:
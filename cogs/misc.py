@@ -93,9 +93,14 @@ class MiscCog(commands.Cog, name='Miscellaneous'):
                     'value': f'`{await self.utils.get_tsschecker_version()}`',
                     'inline': False,
                 },
+                {
+                    'name': 'TSSchecker Queue',
+                    'value': f'{self.utils.scheduler.running} running, {self.utils.scheduler.queued} waiting (average wait: {round(self.utils.scheduler.average_wait, 2)}s)',
+                    'inline': False,
+                },
                 {
                     'name': 'SHSH Blobs Saved',
-                    'value': f"**{','.join(textwrap.wrap(str(await asyncio.to_thread(self.utils.shsh_count))[::-1], 3))[::-1]}**",
+                    'value': f"**{','.join(textwrap.wrap(str(self.utils.shsh_count())[::-1], 3))[::-1]}**",
                     'inline': False,
                 },
             ],
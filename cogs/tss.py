@@ -1,6 +1,7 @@
 from .botutils import UtilsCog
 from discord.ext import commands
 from discord import Option
+from utils.archive import ARCHIVE_FORMATS
 from utils.errors import *
 from views.buttons import SelectView, PaginatorView
 from views.selects import DropdownView
@@ -9,7 +10,6 @@ import aiofiles
 import aiopath
 import asyncio
 import discord
-import ujson
 import time
 
 
@@ -38,19 +38,27 @@ class TSSCog(commands.Cog, name='TSS'):
             description='User to download SHSH blobs for',
             required=False,
         ),
+        fmt: Option(
+            str,
+            name='format',
+            description='Archive format',
+            choices=ARCHIVE_FORMATS,
+            default='tar.xz',
+        ),
+        level: Option(
+            int,
+            description='Compression level (0-9)',
+            min_value=0,
+            max_value=9,
+            required=False,
+        ),
     ) -> None:
         if user is None:
             user = ctx.author
         elif (user != ctx.author) and (await ctx.bot.is_owner(ctx.author) == False):
             raise commands.NotOwner()
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (user.id,)
-        ) as cursor:
-            try:
-                devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                devices = list()
+        devices = await self.utils.get_devices(user.id)
 
         if len(devices) == 0:
             raise NoDevicesFound(user)
@@ -117,14 +125,15 @@ class TSSCog(commands.Cog, name='TSS'):
             await ctx.respond(embed=upload_embed, ephemeral=True)
 
         async with aiofiles.tempfile.TemporaryDirectory() as tmpdir:
-            tar = await self.utils.backup_blobs(aiopath.AsyncPath(tmpdir), *ecids)
+            tar = await self.utils.backup_blobs(
+                aiopath.AsyncPath(tmpdir), *ecids, fmt=fmt, level=level
+            )
+
+            embed = discord.Embed(
+                title='Download Blobs', description='Download your SHSH Blobs:'
+            )
+            await self.utils.send_archive(ctx, embed, tar, f'SHSH Blobs.{fmt}')
 
-        embed = discord.Embed(
-            title='Download Blobs', description='Download your SHSH Blobs:'
-        )
-        await ctx.edit(
-            embed=embed, file=discord.File(fp=tar, filename='SHSH Blobs.tar.xz')
-        )
         self.bot.logger.info(f'User: `@{ctx.author}` has downloaded SHSH blobs.')
 
     @tss.command(name='list', description='List your saved SHSH blobs.')
@@ -140,13 +149,7 @@ class TSSCog(commands.Cog, name='TSS'):
         if user is None:
             user = ctx.author
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (user.id,)
-        ) as cursor:
-            try:
-                devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                devices = list()
+        devices = await self.utils.get_devices(user.id)
 
         if len(devices) == 0:
             raise NoDevicesFound(user)
@@ -197,13 +200,7 @@ class TSSCog(commands.Cog, name='TSS'):
     async def save_blobs(self, ctx: discord.ApplicationContext) -> None:
         await ctx.defer(ephemeral=True)
 
-        async with self.bot.db.execute(
-            'SELECT devices from autotss WHERE user = ?', (ctx.author.id,)
-        ) as cursor:
-            try:
-                devices = ujson.loads((await cursor.fetchone())[0])
-            except TypeError:
-                devices = list()
+        devices = await self.utils.get_devices(ctx.author.id)
 
         if len(devices) == 0:
             raise NoDevicesFound(ctx.author)
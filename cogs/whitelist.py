@@ -41,16 +41,18 @@ class WhitelistCog(commands.Cog, name='Whitelist'):
         if not ctx.author.guild_permissions.administrator:
             raise commands.MissingPermissions(['administrator'])
 
-        async with self.bot.db.execute(
-            'SELECT * FROM whitelist WHERE guild = ?', (ctx.guild.id,)
-        ) as cursor:
-            if await cursor.fetchone() is None:
-                sql = 'INSERT INTO whitelist(channel, enabled, guild) VALUES(?,?,?)'
-            else:
-                sql = 'UPDATE whitelist SET channel = ?, enabled = ? WHERE guild = ?'
+        if (
+            await self.bot.db.fetchone(
+                'SELECT * FROM whitelist WHERE guild = ?', (ctx.guild.id,)
+            )
+            is None
+        ):
+            sql = 'INSERT INTO whitelist(channel, enabled, guild) VALUES(?,?,?)'
+        else:
+            sql = 'UPDATE whitelist SET channel = ?, enabled = ? WHERE guild = ?'
 
-            await self.bot.db.execute(sql, (channel.id, True, ctx.guild.id))
-            await self.bot.db.commit()
+        await self.bot.db.execute(sql, (channel.id, True, ctx.guild.id))
+        await self.bot.db.commit()
 
         embed = discord.Embed(
             title='Whitelist',
@@ -75,10 +77,9 @@ class WhitelistCog(commands.Cog, name='Whitelist'):
 
         await ctx.defer()
 
-        async with self.bot.db.execute(
+        data = await self.bot.db.fetchone(
             'SELECT * FROM whitelist WHERE guild = ?', (ctx.guild.id,)
-        ) as cursor:
-            data = await cursor.fetchone()
+        )
 
         if data is None:
             raise commands.BadArgument('No whitelist channel is set.')
@@ -0,0 +1,281 @@
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, BinaryIO, Iterable, Optional
+from utils.diskcache import DiskCache
+
+import asyncio
+import bz2
+import gzip
+import lzma
+import os
+import pathlib
+import shutil
+import tarfile
+import zipfile
+
+
+ARCHIVE_FORMATS = ('tar.xz', 'tar.gz', 'tar.bz2', 'tar', 'zip')
+DEFAULT_LEVELS = {
+    'tar.xz': 6,
+    'tar.gz': 6,
+    'tar.bz2': 9,
+    'tar': None,
+    'zip': 6,
+}  # Matches each codec's own default
+SPLIT_CHUNK_SIZE = 1024 * 1024
+
+
+class BlobArchiver:
+    def __init__(self, root: str = 'Data/Blobs'):
+        self.root = pathlib.Path(root)
+
+    def sources(self, ecids: Iterable[str]) -> list[tuple[pathlib.Path, str]]:
+        ecids = list(ecids)
+        layout = 'single' if len(ecids) == 1 else 'multi'
+
+        return [source for ecid in ecids for source in self.ecid_sources(ecid, layout)]
+
+    def ecid_sources(self, ecid: str, layout: str) -> list[tuple[pathlib.Path, str]]:
+        ecid_path = self.root / ecid
+        if not ecid_path.is_dir():
+            return list()
+
+        # A single device's blobs are archived by version, multiple devices by ECID
+        if layout == 'single':
+            return [
+                (firm, f'SHSH Blobs/{firm.name}')
+                for firm in sorted(ecid_path.iterdir())
+                if firm.is_dir()
+            ]
+
+        return [(ecid_path, f'SHSH Blobs/{ecid}')]
+
+    def _open_stream(
+        self, path: pathlib.Path, fmt: str, level: int, mode: str = 'wb'
+    ) -> BinaryIO:
+        codec = fmt.split('.')[-1]
+        if codec == 'xz':
+            return lzma.open(path, mode, preset=level)
+        elif codec == 'gz':
+            return gzip.open(path, mode, compresslevel=level)
+        elif codec == 'bz2':
+            return bz2.open(path, mode, compresslevel=max(level, 1))
+
+        return open(path, mode)
+
+    def _open_tar(
+        self, path: pathlib.Path, fmt: str, level: Optional[int]
+    ) -> tarfile.TarFile:
+        if fmt == 'tar':
+            return tarfile.open(path, 'w')
+
+        codec = fmt.split('.')[-1]
+        if codec == 'xz':
+            return tarfile.open(path, 'w:xz', preset=level)
+
+        elif codec == 'bz2':
+            level = max(level, 1)  # bzip2 has no "store" level
+
+        return tarfile.open(path, f'w:{codec}', compresslevel=level)
+
+    def _write_zip(
+        self,
+        path: pathlib.Path,
+        sources: list[tuple[pathlib.Path, str]],
+        level: Optional[int],
+    ) -> None:
+        with zipfile.ZipFile(
+            path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=level
+        ) as zip:
+            for source, arcname in sources:
+                for dirpath, dirnames, filenames in os.walk(source):
+                    dirnames.sort()
+                    relpath = pathlib.Path(dirpath).relative_to(source).as_posix()
+                    dirname = arcname if relpath == '.' else f'{arcname}/{relpath}'
+
+                    for name in sorted(filenames):
+                        zip.write(os.path.join(dirpath, name), f'{dirname}/{name}')
+
+    def write(
+        self,
+        path: pathlib.Path,
+        ecids: Iterable[str],
+        fmt: str = 'tar.xz',
+        level: Optional[int] = None,
+    ) -> bool:
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f'Unsupported archive format: {fmt}')
+
+        sources = self.sources(ecids)
+        if len(sources) == 0:
+            return False
+
+        if level is None:
+            level = DEFAULT_LEVELS[fmt]
+
+        # Blobs are read straight from the blob store and compressed into the archive
+        # as they're added, so only one file is ever held in memory
+        if fmt == 'zip':
+            self._write_zip(path, sources, level)
+        else:
+            with self._open_tar(path, fmt, level) as tar:
+                for source, arcname in sources:
+                    tar.add(source, arcname=arcname)
+
+        return True
+
+    def write_fragment(
+        self, path: pathlib.Path, ecid: str, layout: str, fmt: str, level: int
+    ) -> bool:
+        sources = self.ecid_sources(ecid, layout)
+        if len(sources) == 0:
+            return False
+
+        # Compressed gzip, bzip2 and xz streams can be concatenated, so each device's
+        # blobs are compressed on their own and joined together with concat()
+        with self._open_stream(path, fmt, level) as stream:
+            tar = tarfile.open(fileobj=stream, mode='w')
+            for source, arcname in sources:
+                tar.add(source, arcname=arcname)
+
+            tar.closed = True  # Leave out the end-of-archive blocks
+
+        return True
+
+    def concat(
+        self, path: pathlib.Path, fragments: list[pathlib.Path], fmt: str, level: int
+    ) -> None:
+        with open(path, 'wb') as f:
+            for fragment in fragments:
+                with open(fragment, 'rb') as frag:
+                    shutil.copyfileobj(frag, f)
+
+        with self._open_stream(path, fmt, level, 'ab') as stream:
+            stream.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+
+    def split(self, path: pathlib.Path, size: int) -> list[pathlib.Path]:
+        if path.stat().st_size <= size:
+            return [path]
+
+        # Parts are named like split(1)'s output, so they can be joined back with cat
+        parts = list()
+        with open(path, 'rb') as f:
+            while True:
+                part = path.with_name(f'{path.name}.{len(parts) + 1:03}')
+                with open(part, 'wb') as p:
+                    remaining = size
+                    while remaining > 0:
+                        chunk = f.read(min(SPLIT_CHUNK_SIZE, remaining))
+                        if len(chunk) == 0:
+                            break
+
+                        p.write(chunk)
+                        remaining -= len(chunk)
+
+                if remaining == size:  # Nothing left to split
+                    part.unlink()
+                    break
+
+                parts.append(part)
+
+        path.unlink()
+        return parts
+
+
+class ArchiveCache:
+    def __init__(
+        self,
+        archiver: BlobArchiver,
+        path: str = 'Data/Cache/Archives',
+        executor: Optional[Executor] = None,
+        max_size: int = 256,
+    ):
+        self.archiver = archiver
+        self.path = pathlib.Path(path)
+        self.executor = executor  # Fragments are compressed in threads if not set
+        self._cache = DiskCache(
+            self.path, '*/*', max_size * 1024 * 1024
+        )  # MiB -> bytes
+
+        # Bumped whenever an ECID's blobs change, so fragments built from old blobs are discarded
+        self._epoch = 0
+        self._generations: dict[str, int] = dict()
+
+    @property
+    def max_size(self) -> int:
+        return self._cache.max_size
+
+    @max_size.setter
+    def max_size(self, max_size: int) -> None:
+        self._cache.max_size = max_size
+
+    def _name(self, ecid: str, layout: str, fmt: str, level: int) -> str:
+        return f'{ecid}/{layout}-{level}.{fmt}'
+
+    def _store(self, tmp_path: pathlib.Path, fragment: pathlib.Path) -> int:
+        tmp_path.replace(fragment)
+        return fragment.stat().st_size
+
+    @asynccontextmanager
+    async def fragments(
+        self, ecids: Iterable[str], layout: str, fmt: str, level: Optional[int] = None
+    ) -> AsyncIterator[list[pathlib.Path]]:
+        if level is None:
+            level = DEFAULT_LEVELS[fmt] or 0
+
+        # Pin every fragment up front, so building one can't evict another
+        ecids = list(ecids)
+        async with self._cache.pinned(
+            [self._name(ecid, layout, fmt, level) for ecid in ecids]
+        ):
+            fragments = await asyncio.gather(
+                *[self.get(ecid, layout, fmt, level) for ecid in ecids]
+            )
+            yield [fragment for fragment in fragments if fragment is not None]
+
+    async def get(
+        self, ecid: str, layout: str, fmt: str, level: Optional[int] = None
+    ) -> Optional[pathlib.Path]:
+        if level is None:
+            level = DEFAULT_LEVELS[fmt] or 0
+
+        key = (ecid, layout, fmt, level)
+        # Only build each fragment once, no matter how many downloads need it
+        return await self._cache.get(
+            self._name(*key), lambda fragment: self._build(key, fragment)
+        )
+
+    async def _build(self, key: tuple, fragment: pathlib.Path) -> Optional[int]:
+        ecid = key[0]
+        while True:
+            generation = (self._epoch, self._generations.get(ecid, 0))
+
+            await asyncio.to_thread(fragment.parent.mkdir, parents=True, exist_ok=True)
+            tmp_path = fragment.with_name(f'{fragment.name}.tmp')
+            try:
+                if not await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.archiver.write_fragment, tmp_path, *key
+                ):
+                    return None
+            except FileNotFoundError:  # Cache was invalidated while building
+                continue
+
+            if (
+                self._epoch,
+                self._generations.get(ecid, 0),
+            ) == generation:  # Blobs weren't changed while building
+                try:
+                    return await asyncio.to_thread(self._store, tmp_path, fragment)
+                except FileNotFoundError:  # Invalidated while moving it into place
+                    continue
+
+    async def invalidate(self, ecid: str = None) -> None:
+        if ecid is None:
+            self._epoch += 1
+            path = self.path
+        else:
+            self._generations[ecid] = self._generations.get(ecid, 0) + 1
+            path = self.path / ecid
+
+        self._cache.discard(ecid)
+        await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
@@ -0,0 +1,245 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import aiohttp
+import asyncio
+import struct
+import zlib
+
+
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+EOCD64_SIGNATURE = b'PK\x06\x06'
+CD_SIGNATURE = b'PK\x01\x02'
+LOCAL_SIGNATURE = b'PK\x03\x04'
+
+EOCD_SIZE = 22
+EOCD64_LOCATOR_SIZE = 20
+EOCD64_SIZE = 56
+CD_SIZE = 46
+LOCAL_SIZE = 30
+TAIL_SIZE = (
+    EOCD_SIZE + 0xFFFF + EOCD64_LOCATOR_SIZE
+)  # EOCD + max comment + ZIP64 locator
+
+
+class RemoteZipError(Exception):
+    pass
+
+
+class ZipMember(NamedTuple):
+    name: str
+    method: int
+    crc: int
+    compressed_size: int
+    size: int
+    offset: int
+
+
+class AsyncRemoteZip:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        cache_size: int = 64,
+        timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(total=30),
+    ):
+        self.session = session
+        self.cache_size = cache_size
+        self.timeout = timeout  # Per range request, instead of the session's default
+
+        self._directories: OrderedDict[str, dict[str, ZipMember]] = OrderedDict()
+        self._pending: dict[str, asyncio.Task] = dict()
+
+    async def _get_range(self, url: str, byte_range: str) -> tuple[bytes, int]:
+        async with self.session.get(
+            url, headers={'Range': f'bytes={byte_range}'}, timeout=self.timeout
+        ) as resp:
+            if resp.status != 206:  # Never fall back to downloading the whole IPSW
+                raise RemoteZipError(
+                    f'Server did not honor range request for {url} (status {resp.status})'
+                )
+
+            try:
+                total = int(resp.headers['Content-Range'].split('/')[-1])
+            except (KeyError, ValueError):
+                raise RemoteZipError(f'Invalid Content-Range header for {url}')
+
+            return await resp.read(), total
+
+    def _parse_directory(self, data: bytes) -> dict[str, ZipMember]:
+        members = dict()
+        pos = 0
+        while pos + CD_SIZE <= len(data) and data[pos : pos + 4] == CD_SIGNATURE:
+            (
+                flags,
+                method,
+                crc,
+                compressed_size,
+                size,
+                name_len,
+                extra_len,
+                comment_len,
+                offset,
+            ) = (
+                struct.unpack_from('<H', data, pos + 8)
+                + struct.unpack_from('<H', data, pos + 10)
+                + struct.unpack_from('<III', data, pos + 16)
+                + struct.unpack_from('<HHH', data, pos + 28)
+                + struct.unpack_from('<I', data, pos + 42)
+            )
+
+            name_start = pos + CD_SIZE
+            name = data[name_start : name_start + name_len].decode(
+                'utf-8' if flags & 0x800 else 'cp437'
+            )
+
+            extra = data[name_start + name_len : name_start + name_len + extra_len]
+            if 0xFFFFFFFF in (size, compressed_size, offset):
+                size, compressed_size, offset = self._parse_zip64_extra(
+                    extra, size, compressed_size, offset
+                )
+
+            members[name] = ZipMember(name, method, crc, compressed_size, size, offset)
+            pos = name_start + name_len + extra_len + comment_len
+
+        return members
+
+    def _parse_zip64_extra(
+        self, extra: bytes, size: int, compressed_size: int, offset: int
+    ) -> tuple[int, int, int]:
+        pos = 0
+        while pos + 4 <= len(extra):
+            header_id, data_size = struct.unpack_from('<HH', extra, pos)
+            if header_id == 0x0001:  # ZIP64 extended information
+                field = pos + 4
+                if size == 0xFFFFFFFF:
+                    size = struct.unpack_from('<Q', extra, field)[0]
+                    field += 8
+
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = struct.unpack_from('<Q', extra, field)[0]
+                    field += 8
+
+                if offset == 0xFFFFFFFF:
+                    offset = struct.unpack_from('<Q', extra, field)[0]
+
+                break
+
+            pos += 4 + data_size
+
+        return size, compressed_size, offset
+
+    async def _fetch_directory(self, url: str) -> dict[str, ZipMember]:
+        try:
+            return await self._read_directory(url)
+        except (struct.error, UnicodeDecodeError):  # Truncated or corrupt records
+            raise RemoteZipError(f'Malformed central directory in {url}')
+
+    async def _read_directory(self, url: str) -> dict[str, ZipMember]:
+        tail, total = await self._get_range(url, f'-{TAIL_SIZE}')
+        tail_start = max(total - len(tail), 0)
+
+        eocd = tail.rfind(EOCD_SIGNATURE)
+        if eocd == -1 or eocd + EOCD_SIZE > len(tail):
+            raise RemoteZipError(f'No end of central directory record found in {url}')
+
+        cd_size, cd_offset = struct.unpack_from('<II', tail, eocd + 12)
+        if 0xFFFFFFFF in (cd_size, cd_offset):  # ZIP64 archive
+            locator = eocd - EOCD64_LOCATOR_SIZE
+            if locator < 0 or tail[locator : locator + 4] != EOCD64_LOCATOR_SIGNATURE:
+                raise RemoteZipError(
+                    f'No ZIP64 end of central directory locator in {url}'
+                )
+
+            eocd64_offset = struct.unpack_from('<Q', tail, locator + 8)[0]
+            if eocd64_offset >= tail_start:
+                eocd64 = tail[eocd64_offset - tail_start :]
+            else:
+                eocd64, _ = await self._get_range(
+                    url, f'{eocd64_offset}-{eocd64_offset + EOCD64_SIZE - 1}'
+                )
+
+            if eocd64[:4] != EOCD64_SIGNATURE:
+                raise RemoteZipError(f'Invalid ZIP64 end of central directory in {url}')
+
+            cd_size, cd_offset = struct.unpack_from('<QQ', eocd64, 40)
+
+        if cd_offset >= tail_start:  # Central directory was included in the tail
+            directory = tail[cd_offset - tail_start : cd_offset - tail_start + cd_size]
+        else:
+            directory, _ = await self._get_range(
+                url, f'{cd_offset}-{cd_offset + cd_size - 1}'
+            )
+
+        return self._parse_directory(directory)
+
+    async def _get_directory(self, url: str) -> dict[str, ZipMember]:
+        if url in self._directories.keys():
+            self._directories.move_to_end(url)
+            return self._directories[url]
+
+        if url not in self._pending.keys():
+            self._pending[url] = asyncio.ensure_future(self._fetch_directory(url))
+
+        try:
+            directory = await asyncio.shield(self._pending[url])
+        finally:
+            self._pending.pop(url, None)
+
+        self._directories[url] = directory
+        while len(self._directories) > self.cache_size:
+            self._directories.popitem(last=False)
+
+        return directory
+
+    async def namelist(self, url: str) -> list[str]:
+        return list((await self._get_directory(url)).keys())
+
+    async def read(self, url: str, name: str) -> bytes:
+        member = (await self._get_directory(url)).get(name)
+        if member is None:
+            raise RemoteZipError(f'{name} not found in {url}')
+
+        header, _ = await self._get_range(
+            url, f'{member.offset}-{member.offset + LOCAL_SIZE - 1}'
+        )
+        if header[:4] != LOCAL_SIGNATURE:
+            raise RemoteZipError(f'Invalid local file header for {name} in {url}')
+
+        try:
+            name_len, extra_len = struct.unpack_from('<HH', header, 26)
+        except struct.error:
+            raise RemoteZipError(f'Truncated local file header for {name} in {url}')
+
+        data_start = member.offset + LOCAL_SIZE + name_len + extra_len
+
+        if member.compressed_size == 0:
+            data = b''
+        else:
+            data, _ = await self._get_range(
+                url, f'{data_start}-{data_start + member.compressed_size - 1}'
+            )
+
+        if member.method == 0:  # Stored
+            content = data
+        elif member.method == 8:  # Deflated
+            try:
+                content = await asyncio.to_thread(zlib.decompress, data, -15)
+            except zlib.error:
+                raise RemoteZipError(f'Corrupt compressed data for {name} in {url}')
+        else:
+            raise RemoteZipError(
+                f'Unsupported compression method {member.method} for {name} in {url}'
+            )
+
+        if zlib.crc32(content) != member.crc:
+            raise RemoteZipError(f'CRC mismatch for {name} in {url}')
+
+        return content
+
+    async def read_member(self, url: str, match: str) -> Optional[bytes]:
+        name = next((n for n in await self.namelist(url) if match in n), None)
+        if name is None:
+            return None
+
+        return await self.read(url, name)
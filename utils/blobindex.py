@@ -0,0 +1,83 @@
+from typing import Iterable, Optional
+
+import os
+import pathlib
+
+
+class BlobIndex:
+    def __init__(self, root: str = 'Data/Blobs'):
+        self.root = pathlib.Path(root)
+        self.total = 0
+
+        # ECID -> save directory (relative to the ECID's directory) -> blob name -> generator
+        self._blobs: dict[str, dict[str, dict[str, Optional[str]]]] = dict()
+        self._counts: dict[str, int] = dict()
+
+    def scan(self) -> list[tuple[str, str, str, Optional[str]]]:
+        blobs = list()
+        if not self.root.is_dir():
+            return blobs
+
+        for ecid in os.scandir(self.root):
+            if not ecid.is_dir():
+                continue
+
+            for dirpath, _, filenames in os.walk(ecid.path):
+                path = pathlib.Path(dirpath).relative_to(ecid.path).as_posix()
+                for name in filenames:
+                    if '.shsh' in name:
+                        blobs.append((ecid.name, path, name, None))
+
+        return blobs
+
+    def load(self, blobs: Iterable[tuple[str, str, str, Optional[str]]]) -> None:
+        self._blobs = dict()
+        self._counts = dict()
+        self.total = 0
+
+        for ecid, path, name, generator in blobs:
+            self.add(ecid, path, {name: generator})
+
+    def add(self, ecid: str, path: str, blobs: dict[str, Optional[str]]) -> None:
+        saved = self._blobs.setdefault(ecid, dict()).setdefault(path, dict())
+        new_blobs = len([name for name in blobs.keys() if name not in saved.keys()])
+        saved.update(blobs)
+
+        self._counts[ecid] = self._counts.get(ecid, 0) + new_blobs
+        self.total += new_blobs
+
+    def remove(self, ecid: str, path: str = None) -> None:
+        if ecid not in self._blobs.keys():
+            return
+
+        if path is None:
+            removed = self._counts.pop(ecid, 0)
+            del self._blobs[ecid]
+        else:
+            removed = len(self._blobs[ecid].pop(path, dict()))
+            self._counts[ecid] -= removed
+
+        self.total -= removed
+
+    def get(self, ecid: str, path: str) -> dict[str, Optional[str]]:
+        return dict(self._blobs.get(ecid, dict()).get(path, dict()))
+
+    def count(self, ecid: str = None, version: str = None, buildid: str = None) -> int:
+        if ecid is None:
+            return self.total
+
+        if version is None and buildid is None:
+            return self._counts.get(ecid, 0)
+
+        count = 0
+        for path, blobs in self._blobs.get(ecid, dict()).items():
+            parts = path.split('/')
+            if version is not None and parts[0] != version:
+                continue
+
+            if buildid is not None and (len(parts) < 2 or parts[1] != buildid):
+                continue
+
+            count += len(blobs)
+
+        return count
@@ -0,0 +1,46 @@
+from typing import Any, Awaitable, Callable, Hashable
+
+import asyncio
+import time
+
+
+class AsyncTTLCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data: dict[Hashable, tuple[float, Any]] = dict()
+        self._pending: dict[Hashable, asyncio.Task] = dict()
+
+    async def get(
+        self,
+        key: Hashable,
+        factory: Callable[[], Awaitable],
+        *,
+        refresh: bool = False,
+    ) -> Any:
+        if not refresh and key in self._data.keys():
+            expires, value = self._data[key]
+            if time.monotonic() < expires:
+                return value
+
+        if (
+            key not in self._pending.keys()
+        ):  # Only one fetch per key is ever in flight, everyone else waits on it
+            task = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda t: self._store(key, t))
+            self._pending[key] = task
+
+        # Shield the shared task so one caller being cancelled doesn't cancel it for the rest
+        return await asyncio.shield(self._pending[key])
+
+    def _store(self, key: Hashable, task: asyncio.Task) -> None:
+        self._pending.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        self._data[key] = (time.monotonic() + self.ttl, task.result())
+
+    def invalidate(self, key: Hashable = None) -> None:
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
@@ -0,0 +1,103 @@
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Iterable, Optional
+
+import aiosqlite
+import asyncio
+import time
+
+
+class Database:
+    def __init__(self, conn: aiosqlite.Connection, window: float = 0.05):
+        self.conn = conn  # All writes go through this connection
+        self.window = window  # Seconds to wait for other writes before committing
+
+        self.commits = 0
+        self.commit_requests = 0
+        self.total_commit_time = 0
+        self.max_commit_time = 0
+
+        self._pending: Optional[asyncio.Task] = None
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._reader_conns: list[aiosqlite.Connection] = list()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.conn, name)
+
+    @property
+    def average_commit_time(self) -> float:
+        if self.commits == 0:
+            return 0
+
+        return self.total_commit_time / self.commits
+
+    async def open_readers(self, path: str, size: int) -> None:
+        for _ in range(size):
+            reader = await aiosqlite.connect(f'file:{path}?mode=ro', uri=True)
+            self._reader_conns.append(reader)
+            self._readers.put_nowait(reader)
+
+    async def close_readers(self) -> None:
+        for reader in self._reader_conns:
+            await reader.close()
+
+        self._reader_conns = list()
+        self._readers = asyncio.Queue()
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        if len(self._reader_conns) == 0:  # No read pool, so read from the writer
+            yield self.conn
+            return
+
+        reader = await self._readers.get()
+        try:
+            yield reader
+        finally:
+            self._readers.put_nowait(reader)
+
+    async def fetchone(self, sql: str, params: Iterable[Any] = ()) -> Optional[tuple]:
+        async with self.reader() as reader:
+            async with reader.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params: Iterable[Any] = ()) -> list[tuple]:
+        async with self.reader() as reader:
+            async with reader.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def execute(self, sql: str, params: Iterable[Any] = ()) -> aiosqlite.Cursor:
+        return await self.conn.execute(sql, params)
+
+    async def executemany(
+        self, sql: str, params: Iterable[Iterable[Any]]
+    ) -> aiosqlite.Cursor:
+        return await self.conn.executemany(sql, params)
+
+    async def commit(self) -> None:
+        self.commit_requests += 1
+
+        # Writes that arrive within the window share one transaction
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._commit())
+
+        await asyncio.shield(self._pending)
+
+    async def _commit(self) -> None:
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._pending = None  # Later writes are committed by the next transaction
+
+        start_time = time.perf_counter()
+        await self.conn.commit()
+        commit_time = time.perf_counter() - start_time
+
+        self.commits += 1
+        self.total_commit_time += commit_time
+        self.max_commit_time = max(self.max_commit_time, commit_time)
+
+    def reset_stats(self) -> None:
+        self.commits = 0
+        self.commit_requests = 0
+        self.total_commit_time = 0
+        self.max_commit_time = 0
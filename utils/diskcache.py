@@ -0,0 +1,118 @@
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+import asyncio
+import os
+import pathlib
+
+
+class DiskCache:
+    def __init__(self, path: str, pattern: str, max_size: int):
+        self.path = pathlib.Path(path)
+        self.pattern = pattern  # Glob matching cached files, relative to the cache
+        self.max_size = max_size  # Bytes
+
+        # File path (relative to the cache) -> size, in LRU order, oldest first
+        self._entries: Optional[OrderedDict[str, int]] = None
+        self._pending: dict[str, asyncio.Task] = dict()
+        self._pinned: Counter[str] = Counter()
+        self._lock = asyncio.Lock()
+
+    def _load(self) -> OrderedDict[str, int]:
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        files = sorted(
+            (f.stat().st_mtime, f.relative_to(self.path).as_posix(), f.stat().st_size)
+            for f in self.path.glob(self.pattern)
+            if f.suffix != '.tmp'
+        )
+        return OrderedDict((name, size) for _, name, size in files)
+
+    def _evict(self, keep: Optional[str] = None) -> list[str]:
+        # Runs on the event loop, since the LRU order is only ever touched there
+        evicted = list()
+        total = sum(self._entries.values())
+        for name in list(self._entries.keys()):
+            if total <= self.max_size:
+                break
+
+            if name == keep or self._pinned[name] > 0:
+                continue
+
+            total -= self._entries.pop(name)
+            evicted.append(name)
+
+        return evicted
+
+    def _unlink(self, names: list[str]) -> None:
+        for name in names:
+            (self.path / name).unlink(missing_ok=True)
+
+    async def get(
+        self, name: str, create: Callable[[pathlib.Path], Awaitable[Optional[int]]]
+    ) -> Optional[pathlib.Path]:
+        async with self._lock:
+            if self._entries is None:
+                self._entries = await asyncio.to_thread(self._load)
+
+        path = self.path / name
+        if name in self._entries.keys():
+            self._entries.move_to_end(name)
+            try:  # Keep LRU order across restarts
+                await asyncio.to_thread(os.utime, path)
+                return path
+            except FileNotFoundError:  # Evicted or removed from disk, so create it again
+                self._entries.pop(name, None)
+
+        if (
+            name not in self._pending.keys()
+        ):  # Only create each file once, no matter how many callers need it
+            self._pending[name] = asyncio.ensure_future(
+                self._create(name, path, create)
+            )
+
+        return await asyncio.shield(self._pending[name])
+
+    async def _create(
+        self,
+        name: str,
+        path: pathlib.Path,
+        create: Callable[[pathlib.Path], Awaitable[Optional[int]]],
+    ) -> Optional[pathlib.Path]:
+        try:
+            size = await create(path)  # Writes the file and returns its size
+            if size is None:
+                return None
+
+            self._entries[name] = size
+            await asyncio.to_thread(self._unlink, self._evict(name))
+
+            return path
+        finally:
+            self._pending.pop(name, None)
+
+    @asynccontextmanager
+    async def pinned(self, names: Iterable[str]) -> AsyncIterator[None]:
+        # Pinned files are never evicted, so the cache can briefly grow past its limit
+        names = list(names)
+        self._pinned.update(names)
+        try:
+            yield
+        finally:
+            self._pinned.subtract(names)
+            self._pinned += Counter()  # Drop files that are no longer pinned
+            if self._entries is not None:
+                await asyncio.to_thread(self._unlink, self._evict())
+
+    def discard(self, name: Optional[str] = None) -> None:
+        # Forgets a file or directory that the caller is removing, or everything
+        if self._entries is None:
+            return
+
+        for entry in [
+            entry
+            for entry in self._entries.keys()
+            if name is None or entry == name or entry.startswith(f'{name}/')
+        ]:
+            del self._entries[entry]
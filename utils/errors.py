@@ -5,6 +5,13 @@ class AutoTSSError(Exception):
     pass
 
 
+class APIError(AutoTSSError):
+    def __init__(self, url: str, status: int) -> None:
+        super().__init__(f'Request to {url} failed with status {status}')
+        self.url = url
+        self.status = status
+
+
 class StopCommand(AutoTSSError):
     pass
 
@@ -0,0 +1,65 @@
+from hashlib import sha1
+from typing import Optional, Union
+
+import aiopath
+import ujson
+
+
+class HTTPCache:
+    def __init__(self, path: str = 'Data/Cache/HTTP'):
+        self.path = aiopath.AsyncPath(path)
+        self._entries: dict[str, dict] = dict()
+
+    def _entry_path(self, url: str) -> aiopath.AsyncPath:
+        return self.path / f'{sha1(url.encode()).hexdigest()}.json'
+
+    async def get(self, url: str) -> Optional[dict]:
+        if url in self._entries:
+            return self._entries[url]
+
+        entry_path = self._entry_path(url)
+        if not await entry_path.is_file():
+            return None
+
+        try:
+            entry = ujson.loads(await entry_path.read_text())
+        except ValueError:  # Corrupted cache entry
+            await entry_path.unlink(missing_ok=True)
+            return None
+
+        if entry.get('url') != url:
+            return None
+
+        self._entries[url] = entry
+        return entry
+
+    def headers(self, entry: Optional[dict]) -> dict:
+        headers = dict()
+        if entry is None:
+            return headers
+
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    async def store(self, url: str, headers, data: Union[dict, list]) -> None:
+        entry = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'data': data,
+        }
+
+        if entry['etag'] is None and entry['last_modified'] is None:
+            # Responses without validators can't be revalidated, so don't cache them
+            self._entries.pop(url, None)
+            return
+
+        self._entries[url] = entry
+
+        await self.path.mkdir(parents=True, exist_ok=True)
+        await self._entry_path(url).write_text(ujson.dumps(entry))
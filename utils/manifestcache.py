@@ -0,0 +1,43 @@
+from hashlib import sha1
+from typing import Awaitable, Callable, Optional
+from utils.diskcache import DiskCache
+
+import asyncio
+import pathlib
+
+
+class ManifestCache:
+    def __init__(self, path: str = 'Data/Cache/Manifests', max_size: int = 512):
+        self.path = pathlib.Path(path)
+        self._cache = DiskCache(
+            self.path, '*.plist', max_size * 1024 * 1024
+        )  # MiB -> bytes
+
+    def _store(self, manifest_path: pathlib.Path, manifest: bytes) -> None:
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with tmp_path.open('wb') as f:
+            f.write(manifest)
+
+        tmp_path.replace(manifest_path)
+
+    async def get(
+        self, url: str, fetch: Callable[[str], Awaitable[Optional[bytes]]]
+    ) -> Optional[pathlib.Path]:
+        key = sha1(url.encode()).hexdigest()
+
+        async def _fetch(manifest_path: pathlib.Path) -> Optional[int]:
+            manifest = await fetch(url)
+            if manifest is None:
+                return None
+
+            await asyncio.to_thread(self._store, manifest_path, manifest)
+            return len(manifest)
+
+        # Only download each manifest once, no matter how many devices need it
+        return await self._cache.get(f'{key}.plist', _fetch)
+
+    async def invalidate(self, url: str) -> None:
+        key = sha1(url.encode()).hexdigest()
+        self._cache.discard(f'{key}.plist')
+
+        await asyncio.to_thread((self.path / f'{key}.plist').unlink, missing_ok=True)
@@ -0,0 +1,86 @@
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+import asyncio
+import time
+
+
+class ProcessScheduler:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+
+        self.total_waits = 0
+        self.total_wait_time = 0
+
+        # Waiters are queued per key and served round-robin, so one user with
+        # many devices can't starve everyone else
+        self._queues: OrderedDict[Hashable, deque[asyncio.Future]] = OrderedDict()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def average_wait(self) -> float:
+        if self.total_waits == 0:
+            return 0
+
+        return self.total_wait_time / self.total_waits
+
+    async def _acquire(self, key: Hashable) -> None:
+        if self.running < self.limit and len(self._queues) == 0:
+            self.running += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if (
+                waiter.done() and not waiter.cancelled()
+            ):  # Slot was already handed to us
+                self._release()
+            else:
+                queue = self._queues.get(key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if len(queue) == 0:
+                        del self._queues[key]
+
+            raise
+
+    def _release(self) -> None:
+        while len(self._queues) > 0:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if len(queue) == 0:
+                del self._queues[key]
+            else:
+                self._queues.move_to_end(key)
+
+            if not waiter.done():  # Hand the slot straight to the next waiter
+                waiter.set_result(None)
+                return
+
+        self.running -= 1
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable) -> AsyncIterator[None]:
+        start_time = time.perf_counter()
+        await self._acquire(key)
+
+        self.total_waits += 1
+        self.total_wait_time += time.perf_counter() - start_time
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def reset_stats(self) -> None:
+        self.total_waits = 0
+        self.total_wait_time = 0